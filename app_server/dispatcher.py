@@ -5,16 +5,92 @@ from __future__ import unicode_literals, division, print_function, with_statemen
 
 import json
 import os
+import re
 import codecs
 import cgi
-import cStringIO
 import logging
+import threading
+import sqlite3 as sqlite
 
 from service.httperrs import *
 from service.speech import Speech
+from service import multipart
+from service import conditional
+from service import metrics
 
 LOG = logging.getLogger("APP.DISPATCHER")
 
+#Attributes holding the SQLite connections of service instances
+SERVICE_CONNECTIONS = ["db", "authdb"]
+
+class Route(object):
+    """
+        Service method for a request: `module` (service class name) and
+        `method`, with required request `parameters`. `path` identifies
+        the route (e.g. in metrics).
+    """
+    __slots__ = ["path", "module", "method", "parameters"]
+
+    def __init__(self, path, module, method, parameters=()):
+        self.path = path
+        self.module = module
+        self.method = method
+        self.parameters = tuple(parameters)
+
+    def missing(self, data):
+        return [parameter for parameter in self.parameters if parameter not in data]
+
+    def __repr__(self):
+        return "Route({}.{}{})".format(self.module, self.method, list(self.parameters))
+
+
+class Router(object):
+    """
+        Routing table compiled from the dispatcher config: static routes
+        are looked up by path, speech server callbacks on per-job URLs
+        (/<module>/<token>, see "TEMPIO_MODULES") are matched by a single
+        precompiled pattern.
+    """
+    #Service methods handling speech server callbacks
+    TEMPIO_METHODS = {"GET" : "outgoing", "PUT" : "incoming"}
+
+    def __init__(self):
+        self._static = {} #uri -> {http_method -> Route}
+        self._tempio = {} #module name -> {http_method -> Route}
+        self._pattern = None
+
+    def add(self, http_method, uri, module, method, parameters):
+        self._static.setdefault(uri, {})[http_method] = Route(uri, module, method, parameters)
+
+    def add_tempio(self, name, module):
+        self._tempio[name] = dict((http_method, Route("/{}/<token>".format(name), module, method)) for http_method, method in self.TEMPIO_METHODS.items())
+
+    def compile(self):
+        if self._tempio:
+            names = "|".join(re.escape(name) for name in sorted(self._tempio))
+            self._pattern = re.compile(r"^/({})/([^/]+)$".format(names))
+
+    def match(self, http_method, uri):
+        """
+            Returns the Route for a request and, for speech server
+            callbacks, the token in the URI (else None)
+        """
+        routes = self._static.get(uri)
+        token = None
+        if routes is None and self._pattern is not None:
+            m = self._pattern.match(uri)
+            if m is not None:
+                routes, token = self._tempio[m.group(1)], m.group(2)
+        if routes is None:
+            raise NotFoundError("Not found: {}".format(uri))
+        if http_method not in routes:
+            raise MethodNotAllowedError("{} does not support: {}".format(http_method, uri))
+        return routes[http_method], token
+
+    def __repr__(self):
+        return "Router(static={}, tempio={})".format(self._static, sorted(self._tempio))
+
+
 class Dispatch:
 
     def __init__(self, config_file):
@@ -22,8 +98,13 @@ class Dispatch:
         self._config = {}
         self._modules = {}
         self._module_config = {}
-        self._routing = {}
+        self._router = Router()
         self._speech = None
+        #Service instances are kept per thread (SQLite connections may
+        #not be shared between threads) and rebuilt when the generation
+        #changes, see `reload()`
+        self._local = threading.local()
+        self._generation = 0
 
     def load(self):
         """
@@ -36,6 +117,114 @@ class Dispatch:
         self._speech = Speech(self._config_file)
         self._speech.login()
 
+    def reload(self):
+        """
+            Reload config and routing and rebuild service instances (on
+            each thread's next request)
+        """
+        LOG.info("Reloading router...")
+        self.load_config()
+        self.load_handlers() #replaces the routing table in one step
+        self._generation += 1
+
+    def config_files(self):
+        """
+            Dispatcher and module config files, e.g. to watch for changes
+        """
+        return [self._config_file] + sorted(set(self._module_config.values()))
+
+    def auth_dbs(self):
+        """
+            Authentication databases used by the modules
+        """
+        authdbs = set()
+        for module_config in set(self._module_config.values()):
+            with codecs.open(module_config, 'r', 'utf-8') as f:
+                config = json.load(f)
+            authdbs.update(config[key] for key in ["authdb", "target_authdb"] if key in config)
+        return sorted(authdbs)
+
+    def _service(self, modu):
+        """
+            Long-lived instance of service `modu` for the current thread
+        """
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            self._close_services()
+            local.services = {}
+            local.generation = self._generation
+        module = local.services.get(modu)
+        if module is not None and not self._healthy(module):
+            LOG.warning("Rebuilding service instance: {}".format(modu))
+            self._close_service(module)
+            module = None
+        if module is None:
+            module_hook = self._modules[modu]
+            module_config = self._module_config[modu]
+            try:
+                module = module_hook(module_config, self._speech)
+            except TypeError as e:
+                if "__init__()" in str(e):
+                    module = module_hook(module_config)
+                else:
+                    raise
+            module._dispatch_dbfiles = self._db_files(module)
+            local.services[modu] = module
+        return module
+
+    def _db_files(self, module):
+        """
+            Identity (device, inode) of the database file behind each
+            connection of service instance `module`
+        """
+        dbfiles = {}
+        for attr in SERVICE_CONNECTIONS:
+            conn = getattr(module, attr, None)
+            if conn is not None:
+                dbfiles[attr] = None
+                for row in conn.execute("PRAGMA database_list").fetchall():
+                    if row[1] == "main" and row[2]:
+                        st = os.stat(row[2])
+                        dbfiles[attr] = (row[2], st.st_dev, st.st_ino)
+        return dbfiles
+
+    def _healthy(self, module):
+        """
+            Check that the connections of service instance `module` are
+            usable and still refer to the configured database files (a
+            database may have been replaced, e.g. by the tools)
+        """
+        try:
+            for attr, dbfile in module._dispatch_dbfiles.items():
+                conn = getattr(module, attr)
+                conn.rollback() #in case a failed request left a transaction open
+                conn.execute("SELECT 1").fetchone()
+                if dbfile is not None:
+                    st = os.stat(dbfile[0])
+                    if (st.st_dev, st.st_ino) != dbfile[1:]:
+                        return False
+        except (sqlite.Error, OSError) as e:
+            LOG.warning("Service connection check failed: {}".format(e))
+            return False
+        return True
+
+    def _close_service(self, module):
+        for attr in SERVICE_CONNECTIONS:
+            conn = getattr(module, attr, None)
+            if conn is not None:
+                try:
+                    conn.close()
+                except sqlite.Error:
+                    pass
+
+    def _close_services(self):
+        """
+            Close the current thread's service instances
+        """
+        for module in getattr(self._local, "services", {}).values():
+            self._close_service(module)
+        self._local.services = {}
+
     def _parse_module_name(self, module_handle):
         """
             Parse class name -> path, python file, class name
@@ -58,10 +247,7 @@ class Dispatch:
         """
             Clear the routing table i.e. services redirecting
         """
-        if not self._routing:
-            for handler in self._routing:
-                del self._routing[handler]
-        self._routing = {}
+        self._router = Router()
 
     def load_handlers(self):
         """
@@ -73,164 +259,105 @@ class Dispatch:
             self._modules[modu] = getattr(_temp, name)
             self._module_config[modu] = self._config['MODULES'][modu]
 
+        router = Router()
         for http_method in self._config['HANDLERS']:
-            self._routing[http_method] = {}
             for uri in self._config['HANDLERS'][http_method]:
                 modu, method = self._parse_module_name(self._config['HANDLERS'][http_method][uri]['method'])
-                _data = {'module' : modu, 'method' : method, 'parameters' : self._config['HANDLERS'][http_method][uri]['parameters']}
-                self._routing[http_method][uri] = _data
+                router.add(http_method, uri, modu, method, self._config['HANDLERS'][http_method][uri]['parameters'])
+        for modu_name, modu in self._config.get('TEMPIO_MODULES', {}).items():
+            router.add_tempio(modu_name, modu)
+        router.compile()
+        self._router = router #swap in whole, requests on other threads may be using the old table
 
         LOG.debug("Router modules: {}".format(self._modules))
         LOG.debug("Router module config: {}".format(self._module_config))
-        LOG.debug("Router table: {}".format(self._routing))
+        LOG.debug("Router table: {}".format(self._router))
+
+    def _call(self, route, data):
+        """
+            Call the service method for `route` and wrap its result
+        """
+        missing = route.missing(data)
+        if missing:
+            raise BadRequestError('missing parameter in request body: %s' % missing[0])
+        module = self._service(route.module)
+        result = getattr(module, route.method)(data)
+        dispatch_result = dict()
+        if type(result) in [str, unicode]:
+            dispatch_result["message"] = result
+        elif type(result) is dict:
+            dispatch_result.update(result)
+        else:
+            raise Exception("Bad result type from service method")
+        return dispatch_result
 
     def get(self, env):
         """
             Process GET request.
             Valid requests are: results, status, options
         """
+        route, token = self._router.match('GET', env['PATH_INFO'])
+        env[metrics.ROUTE_KEY] = route.path
+        if token is not None: #speech server fetching job input
+            return getattr(self._service(route.module), route.method)(token)
         data = {}
         if len(env['QUERY_STRING']) != 0:
             data = cgi.parse_qs(env['QUERY_STRING'])
         for key in data:
             data[key] = data[key][0]
+        self._add_conditional(env, data)
+        return self._call(route, data)
 
-        uri = env['PATH_INFO']
-        if uri not in self._routing['GET']:
-            try:
-                modu_name = os.path.basename(os.path.dirname(uri))
-                uri = os.path.basename(uri)
-                modu = self._config["TEMPIO_MODULES"][modu_name]
-                module_hook = self._modules[modu]
-                module_config = self._module_config[modu]
-                module = module_hook(module_config, self._speech)
-                return module.outgoing(uri)
-    
-            except MethodNotAllowedError:
-                raise MethodNotAllowedError("GET does not support: {}".format(uri))
-            except Exception as e:
-                raise Exception(str(e))
-        else:
-            for parameter in self._routing['GET'][uri]['parameters']:
-                if parameter not in data:
-                    raise BadRequestError('missing parameter in request body: %s' % parameter)
-
-            module_name = self._routing['GET'][uri]['module']
-            module_config = self._module_config[module_name]
-            module_hook = self._modules[module_name]
-
-            module = module_hook(module_config, self._speech)
-            method = getattr(module, self._routing['GET'][uri]['method'])
-
-            dispatch_result = dict()
-            result = method(data)
-            if type(result) in [str, unicode]:
-                dispatch_result["message"] = result
-            elif type(result) is dict:
-                dispatch_result.update(result)
-            else:
-                raise Exception("Bad result type from service method")
-            return dispatch_result
-
-    def post(self, env):
-        uri = env['PATH_INFO']
-        if uri not in self._routing['POST']:
-            raise MethodNotAllowedError('POST does not support: %s' % uri)
-            
-        data = {}
+    def _parse_body(self, env):
+        """
+            Parse JSON or multipart/form-data request body. File parts
+            are spooled to disk and passed on as `multipart.UploadFile`.
+        """
         if 'multipart/form-data' not in env['CONTENT_TYPE']:
-            data = json.loads(env['wsgi.input'].read(int(env['CONTENT_LENGTH'])))
-        else:
-            (header, bound) = env['CONTENT_TYPE'].split('boundary=')
-            request_body_size = int(env.get('CONTENT_LENGTH', 0))
-            request_body = env['wsgi.input'].read(request_body_size)
-            form_raw = cgi.parse_multipart(cStringIO.StringIO(request_body), {'boundary': bound})
-            for key in form_raw.keys():
-                data[key] = form_raw[key][0]
-            LOG.debug("Data keys: {}".format(data.keys()))
-        for parameter in self._routing['POST'][uri]['parameters']:
-            if parameter not in data:
-                raise BadRequestError('missing parameter in request body: %s' % parameter)
-
-        module_name = self._routing['POST'][uri]['module']
-        module_config = self._module_config[module_name]
-        module_hook = self._modules[module_name]
+            return json.loads(env['wsgi.input'].read(int(env['CONTENT_LENGTH'])))
+        upload = self._config.get("upload", {})
+        data = multipart.parse(env, upload.get("spooldir", os.path.join(os.getenv("PERSISTENT_FS"), "spool")),
+                               upload.get("bufsize", 64 * 1024))
+        LOG.debug("Data keys: {}".format(data.keys()))
+        return data
 
+    def _add_conditional(self, env, data):
+        """
+            Pass conditional request headers (If-None-Match etc.) of a GET
+            request to the service method, see `conditional.check`. Other
+            methods are not conditional: a POST must not be answered with
+            "304 Not Modified".
+        """
+        headers = conditional.from_env(env)
+        if headers and type(data) is dict:
+            data[conditional.REQUEST_KEY] = headers
+
+    def post(self, env):
+        route, token = self._router.match('POST', env['PATH_INFO'])
+        env[metrics.ROUTE_KEY] = route.path
+        data = self._parse_body(env)
         try:
-            module = module_hook(module_config, self._speech)
-        except TypeError as e:
-            if "__init__()" in str(e):
-                module = module_hook(module_config)
-            else:
-                raise
-        method = getattr(module, self._routing['POST'][uri]['method'])
-        dispatch_result = dict()
-        result = method(data)
-        if type(result) in [str, unicode]:
-            dispatch_result["message"] = result
-        elif type(result) is dict:
-            dispatch_result.update(result)
-        else:
-            raise Exception("Bad result type from service method")
-        return dispatch_result
+            return self._call(route, data)
+        finally:
+            multipart.close(data) #Remove spooled uploads not taken over by the service
 
     def put(self, env):
         """ Process PUT resquest.
         """
-        #DEMIT: Refactor the following block? Almost exact copy of "post" method.
-        data = {}
-        if 'multipart/form-data' not in env['CONTENT_TYPE']:
-            data = json.loads(env['wsgi.input'].read(int(env['CONTENT_LENGTH'])))
-        else:
-            (header, bound) = env['CONTENT_TYPE'].split('boundary=')
-            request_body_size = int(env.get('CONTENT_LENGTH', 0))
-            request_body = env['wsgi.input'].read(request_body_size)
-            form_raw = cgi.parse_multipart(cStringIO.StringIO(request_body), {'boundary': bound})
-            for key in form_raw.keys():
-                data[key] = form_raw[key][0]
-            LOG.debug("Data keys: {}".format(data.keys()))
-
-        uri = env['PATH_INFO']
-        if uri not in self._routing['PUT']:
-            try:
-                modu_name = os.path.basename(os.path.dirname(uri))
-                uri = os.path.basename(uri)
-                modu = self._config["TEMPIO_MODULES"][modu_name]
-                module_hook = self._modules[modu]
-                module_config = self._module_config[modu]
-                module = module_hook(module_config, self._speech)
-                return module.incoming(uri, data)
-    
-            except MethodNotAllowedError:
-                raise MethodNotAllowedError("PUT does not support: {}".format(uri))
-            except Exception as e:
-                raise Exception(str(e))
-
-        else:
-            #DEMIT: Refactor the following blocks? Almost exact copy of "post" method.
-            for parameter in self._routing['PUT'][uri]['parameters']:
-                if parameter not in data:
-                    raise BadRequestError('missing parameter in request body: %s' % parameter)
-
-            module_name = self._routing['PUT'][uri]['module']
-            module_config = self._module_config[module_name]
-            module_hook = self._modules[module_name]
-
-            module = module_hook(module_config, self._speech)
-            method = getattr(module, self._routing['PUT'][uri]['method'])
-            dispatch_result = dict()
-            result = method(data)
-            if type(result) in [str, unicode]:
-                dispatch_result["message"] = result
-            elif type(result) is dict:
-                dispatch_result.update(result)
-            else:
-                raise Exception("Bad result type from service method")
-            return dispatch_result
+        route, token = self._router.match('PUT', env['PATH_INFO'])
+        env[metrics.ROUTE_KEY] = route.path
+        data = self._parse_body(env)
+        try:
+            if token is not None: #speech server returning job result
+                return getattr(self._service(route.module), route.method)(token, data)
+            return self._call(route, data)
+        finally:
+            multipart.close(data) #Remove spooled uploads not taken over by the service
 
     def shutdown(self):
         """
             Shutdown
         """
+        self._close_services()
         self._speech.logout()
 
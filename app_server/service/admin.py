@@ -18,6 +18,10 @@ except ImportError:
 import bcrypt #Ubuntu/Debian: apt-get install python-bcrypt
 
 import auth
+import multipart
+import metrics
+import profiler
+import applog
 from httperrs import *
 
 LOG = logging.getLogger("APP.ADMIN")
@@ -67,6 +71,7 @@ class Admin(auth.UserAuth):
         with sqlite.connect(self._config["target_authdb"]) as db_conn:
             db_curs = db_conn.cursor()
             db_curs.execute("DELETE FROM users WHERE username=?", (request["username"],))
+        auth.token_cache(self._config["target_authdb"]).invalidate(username=request["username"])
         LOG.info("Deleted user: {}".format(request["username"]))
         return "User removed"
 
@@ -103,6 +108,7 @@ class Admin(auth.UserAuth):
                 salt, pwhash = auth.hash_pw(request["password"])
                 db_curs.execute("UPDATE users SET pwhash=? WHERE username=?", (pwhash, request["username"]))
                 db_curs.execute("UPDATE users SET salt=? WHERE username=?", (salt, request["username"]))
+        auth.token_cache(self._config["target_authdb"]).invalidate(username=request["username"])
         LOG.info("Updated info for user: {}".format(request["username"]))
         return "User info updated"
 
@@ -127,8 +133,7 @@ class Admin(auth.UserAuth):
         projectid = "clm-{}".format(str(uuid.uuid4()))
         # Write text data to temporary file
         textfile = os.path.join(self._config["tmpdir"], auth.gen_token()) 
-        with open(textfile, 'wb') as f:
-            f.write(request['file'])
+        multipart.save(request['file'], textfile)
         # Add entries in db
         inurl = auth.gen_token()
         outurl = auth.gen_token()
@@ -176,6 +181,25 @@ class Admin(auth.UserAuth):
             row = db.clear_message()
         return "Message records cleared!"
 
+    def get_metrics(self, request):
+        """ Request metrics of all workers in Prometheus text format
+        """
+        self.authdb.authenticate(request["token"], self._config["role"])
+        return {"mime" : metrics.CONTENT_TYPE, "body" : metrics.get().collect()}
+
+    def set_profiler(self, request):
+        """ Enable/disable request profiling on all workers, optionally
+            changing "every", "routes" and "mode" (see profiler.py)
+        """
+        self.authdb.authenticate(request["token"], self._config["role"])
+        settings = dict((key, request[key]) for key in ["enabled", "every", "routes", "mode"] if key in request)
+        try:
+            settings = profiler.get().update(**settings)
+        except (ValueError, TypeError) as e:
+            raise BadRequestError(e)
+        LOG.info("Profiler settings changed: {}".format(settings))
+        return settings
+
     def outgoing(self, uri):
         """ Return the text document
         """
@@ -184,7 +208,7 @@ class Admin(auth.UserAuth):
             with self.db as db: 
                 row = db.get_outgoing(uri)
                 if not row:
-                    raise MethodNotAllowedError(uri)
+                    raise NotFoundError(uri)
             LOG.info("OK: (url={} projectid={}) Returning text file".format(uri, row["projectid"]))
             return {"mime": "text/plain", "filename": row["audiofile"], "savename" : "customlm.txt"}
         except Exception as e:
@@ -194,13 +218,13 @@ class Admin(auth.UserAuth):
     def incoming(self, uri, data):
         """ Save data for retrievel
         """
-        LOG.debug("ENTER: url={} data={}".format(uri, data))
+        LOG.debug("ENTER: url={} data={}".format(uri, applog.redact(data)))
         try:
             LOG.info("ENTER: url={}".format(uri))
             with self.db as db: 
                 row = db.get_incoming(uri)
             if not row: #url exists?
-                raise MethodNotAllowedError(uri)
+                raise NotFoundError(uri)
             #Switch to handler for "servicetype"
             if not row["servicetype"] in self._config["speechservices"]:
                 raise Exception("Service type '{}' not defined in AppServer".format(row["servicetype"]))
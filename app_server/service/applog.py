@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Application logging set up so that log I/O stays off the request
+   path: records are put on a bounded queue (dropped, and counted, when
+   it is full) and written by a background thread in each process.
+
+   All worker processes write to one log file: records are appended
+   under an exclusive `flock` and the file is rotated daily by whichever
+   process first writes on a new day, so that rotation happens once.
+
+   Large payloads (task text, uploaded files, CTM) should be passed
+   through `redact()` before logging. As a safety net, messages longer
+   than `maxmessage` characters are truncated.
+
+   Configured from the "logging" section in dispatcher.json with
+   `configure()`.
+"""
+from __future__ import unicode_literals, division, print_function #Py2
+
+import os
+import time
+import fcntl
+import Queue
+import random
+import logging
+import threading
+
+#Request/result fields holding (potentially large) payloads, e.g. "body"
+#of text responses such as the metrics exposition
+REDACT_FIELDS = ["text", "file", "CTM", "ctm", "body"]
+MAXFIELD = 64 #characters of a redacted field that are kept
+
+def redact(data, maxfield=MAXFIELD):
+    """Copy of request/result dict `data` with payload fields cut to
+       `maxfield` characters (noting the original size)
+    """
+    if type(data) is not dict:
+        return data
+    redacted = {}
+    for key, value in data.items():
+        if key in REDACT_FIELDS:
+            if isinstance(value, basestring):
+                if len(value) > maxfield:
+                    value = "{!r}...<{} chars>".format(value[:maxfield], len(value))
+            else:
+                value = "<{}>".format(type(value).__name__)
+        redacted[key] = value
+    return redacted
+
+
+class CustomFormatter(logging.Formatter):
+    """Custom formatter, overrides funcName with value of funcname if it
+       exists
+    """
+    #The following ensures that we can override "funcName" when logging
+    # from wrapper functions, from:
+    # http://stackoverflow.com/questions/7003898/using-functools-wraps-with-a-logging-decorator
+    def format(self, record):
+        if hasattr(record, 'funcname'):
+            record.funcName = record.funcname
+        return super(CustomFormatter, self).format(record)
+
+
+class SharedFileHandler(logging.Handler):
+    """Appends records to `filename` from any number of processes,
+       rotating it daily to `filename.YYYY-MM-DD` (keeping `backupcount`
+       old files if non-zero)
+    """
+    def __init__(self, filename, backupcount=0, encoding="utf-8"):
+        logging.Handler.__init__(self)
+        self._filename = os.path.abspath(filename)
+        self._backupcount = backupcount
+        self._encoding = encoding
+        self._lockfh = None
+        self._stream = None
+        self._pid = None
+
+    def _open(self):
+        if self._stream is not None:
+            self._stream.close()
+        self._stream = open(self._filename, "a")
+
+    def _rotate(self):
+        """Rotate if the file was last written on a previous day. Must
+           hold the lock.
+        """
+        try:
+            st = os.stat(self._filename)
+        except OSError:
+            return self._open() #rotated, not yet recreated
+        day = time.strftime("%Y-%m-%d", time.localtime(st.st_mtime))
+        if day != time.strftime("%Y-%m-%d") and st.st_size > 0:
+            rotated = "{}.{}".format(self._filename, day)
+            if not os.path.exists(rotated):
+                os.rename(self._filename, rotated)
+                self._prune()
+            self._open()
+        elif self._stream is None or os.fstat(self._stream.fileno()).st_ino != st.st_ino:
+            self._open() #rotated by another process
+
+    def _prune(self):
+        if not self._backupcount:
+            return
+        prefix = os.path.basename(self._filename) + "."
+        dirname = os.path.dirname(self._filename)
+        backups = sorted(name for name in os.listdir(dirname) if name.startswith(prefix) and name != prefix + "lock")
+        for name in backups[:max(0, len(backups) - self._backupcount)]:
+            os.remove(os.path.join(dirname, name))
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + "\n"
+            if isinstance(msg, unicode):
+                msg = msg.encode(self._encoding)
+            if self._pid != os.getpid():
+                #Locks taken through a file inherited from the parent
+                #process would not exclude other children
+                self._pid = os.getpid()
+                self._lockfh = open(self._filename + ".lock", "a")
+            fcntl.flock(self._lockfh, fcntl.LOCK_EX)
+            try:
+                self._rotate()
+                self._stream.write(msg)
+                self._stream.flush()
+            finally:
+                fcntl.flock(self._lockfh, fcntl.LOCK_UN)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        logging.Handler.close(self)
+
+
+class QueueHandler(logging.Handler):
+    """Passes records to `target` (a handler) through a bounded queue
+       serviced by a per-process thread (as in `background`)
+    """
+    def __init__(self, target, maxsize=10000, maxmessage=8192, sampling=None):
+        logging.Handler.__init__(self)
+        self._target = target
+        self._maxsize = maxsize
+        self._maxmessage = maxmessage
+        self._sampling = sorted((sampling or {}).items(), key=lambda item: -len(item[0]))
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._dropped = 0
+        self._startlock = threading.Lock()
+
+    def _running(self):
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def _start(self):
+        with self._startlock:
+            if not self._running():
+                self._pid = os.getpid()
+                self._queue = Queue.Queue(self._maxsize)
+                self._dropped = 0
+                self._thread = threading.Thread(target=self._write, name="logwriter")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _write(self):
+        queue = self._queue
+        while True:
+            record = queue.get()
+            if record is None:
+                break
+            self._target.handle(record)
+
+    def _sampled_out(self, record):
+        """Whether to skip a (below WARNING) record according to the
+           sampling rate of the nearest configured logger
+        """
+        if record.levelno >= logging.WARNING:
+            return False
+        for name, rate in self._sampling:
+            if record.name == name or record.name.startswith(name + "."):
+                return random.random() >= rate
+        return False
+
+    def prepare(self, record):
+        """Format message and exception now (arguments may change or be
+           unpicklable by the time the record is written)
+        """
+        msg = record.getMessage()
+        if len(msg) > self._maxmessage:
+            msg = "{}...<truncated {} chars>".format(msg[:self._maxmessage], len(msg))
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = msg
+        record.args = None
+        return record
+
+    def emit(self, record):
+        if self._sampling and self._sampled_out(record):
+            return
+        try:
+            if not self._running():
+                self._start()
+            if self._dropped:
+                dropped = logging.makeLogRecord({"name" : record.name, "levelno" : logging.WARNING, "levelname" : "WARNING",
+                                                 "msg" : "Log queue full: dropped {} records".format(self._dropped)})
+                self._queue.put_nowait(dropped)
+                self._dropped = 0
+            self._queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self._dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """Write queued records (e.g. at shutdown)
+        """
+        if self._running():
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def configure(logname, filename, fmt, level="DEBUG", levels=None, backupcount=0, maxqueue=10000, maxmessage=8192, sampling=None):
+    """Log logger `logname` (and descendants) to `filename` through a
+       queue. `levels` maps logger names to level names, `sampling` maps
+       logger names to the fraction of their DEBUG/INFO records kept.
+       Returns the `QueueHandler` (flush it at shutdown).
+    """
+    target = SharedFileHandler(filename, backupcount)
+    target.setFormatter(CustomFormatter(fmt))
+    handler = QueueHandler(target, maxqueue, maxmessage, sampling)
+    log = logging.getLogger(logname)
+    log.addHandler(handler)
+    log.setLevel(getattr(logging, level))
+    for name, lvl in (levels or {}).items():
+        logging.getLogger(name).setLevel(getattr(logging, lvl))
+    return handler
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Audio processing shared by the WSGI entry point and service modules:
+   the normalise/re-encode pipeline used to serve (segments of) project
+   audio, an on-disk cache of the resulting task segments and waveform
+   peaks for display in the editor.
+"""
+from __future__ import unicode_literals, division, print_function #Py2
+
+import os
+import time
+import errno
+import fcntl
+import hashlib
+import tempfile
+import math
+import subprocess
+import logging
+
+import numpy as np #Ubuntu/Debian: apt-get install python-numpy
+
+import oggindex
+import limiter
+import util
+
+LOG = logging.getLogger("APP.AUDIO")
+
+# Check binaries are installed
+SOX="/usr/bin/sox"; assert(os.stat(SOX))
+
+#Increment when the output of `Transcoder` changes (invalidates cached segments)
+PIPELINE_VERSION = 3
+
+#Pre-rendered task audio, stored in the task's directory
+TASK_AUDIO = "audio.ogg"
+
+#Renditions selectable by clients: SoX output format options and
+#effects appended to the pipeline. "low" is speech-optimised (16kHz,
+#lowest Vorbis quality, about 24kbps for mono).
+QUALITIES = {"high" : {"options" : [], "effects" : []},
+             "low" : {"options" : ["-C", "-1"], "effects" : ["rate", "16k"]}}
+DEFAULT_QUALITY = "high"
+
+def check_quality(quality):
+    if quality not in QUALITIES:
+        raise ValueError("Unknown audio quality: {} (expected one of: {})".format(quality, ", ".join(sorted(QUALITIES))))
+    return quality
+
+def rendition_path(filename, quality=DEFAULT_QUALITY):
+    """Location of the normalised rendition of uploaded `filename`
+    """
+    if quality == DEFAULT_QUALITY:
+        return "{}.norm.ogg".format(filename)
+    return "{}.{}.ogg".format(filename, quality)
+
+def task_audio_path(taskdir, quality=DEFAULT_QUALITY):
+    """Location of pre-rendered task audio in `taskdir`
+    """
+    if quality == DEFAULT_QUALITY:
+        return os.path.join(taskdir, TASK_AUDIO)
+    return os.path.join(taskdir, "audio.{}.ogg".format(quality))
+
+class Transcoder(object):
+    """Normalise the gain of `filename` and re-encode it as OGG Vorbis in a
+       single SoX process. If `audiorange` = (start, end) in seconds is
+       given only that segment is extracted (located using the file's
+       page index). `quality` selects the output rendition, see
+       `QUALITIES`.
+
+       A pipeline slot is taken from the process-wide `limiter` until
+       SoX exits (`background` jobs wait for a slot instead of being
+       refused).
+
+       Iterate to read the encoded audio as it is produced (see
+       `transcode`, which writes it to a file). `close()` terminates SoX
+       if it is still running and removes temporary files.
+    """
+    BLOCKSIZE = 64 * 1024
+
+    def __init__(self, filename, audiorange=None, quality=DEFAULT_QUALITY, background=False):
+        self._tmpfiles = []
+        self._proc = None
+        self._stderr = None
+        self._slot = limiter.get().acquire(background)
+        try:
+            effects = []
+            source = filename
+            if audiorange is not None:
+                index = oggindex.OggIndex.for_file(filename)
+                #SoX must be able to seek in the segment to trim relative to its end
+                with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as chunk:
+                    self._tmpfiles.append(chunk.name)
+                    segment = index.extract(filename, audiorange[0], audiorange[1], chunk)
+                source = chunk.name
+                effects = segment.sox_trim()
+            self._stderr = tempfile.TemporaryFile()
+            rendition = QUALITIES[check_quality(quality)]
+            cmd = [SOX, "-t", "ogg", source] + rendition["options"] + ["-t", "ogg", "-"] + effects + rendition["effects"] + ["gain", "-n"]
+            LOG.debug(" ".join(cmd))
+            self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=self._stderr)
+            #Fail early (before the output file is created) if SoX cannot run
+            self._first = self._proc.stdout.read(self.BLOCKSIZE)
+            if not self._first:
+                self._finish()
+        except:
+            self.close()
+            raise
+
+    def __iter__(self):
+        block, self._first = self._first, None
+        while block:
+            yield block
+            block = self._proc.stdout.read(self.BLOCKSIZE)
+        self._finish()
+
+    def _finish(self):
+        self._proc.wait()
+        limiter.get().release(self._slot)
+        self._slot = None
+        if self._proc.returncode != 0:
+            self._stderr.seek(0)
+            LOG.error(self._stderr.read())
+            raise RuntimeError("Cannot supply task's audio data!")
+
+    def close(self):
+        if self._proc is not None:
+            if self._proc.returncode is None and self._proc.poll() is None:
+                LOG.debug("Terminating unfinished transcode")
+                self._proc.kill()
+                self._proc.wait()
+            self._proc.stdout.close()
+        if self._stderr is not None:
+            self._stderr.close()
+        for tmpfile in self._tmpfiles:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+        self._tmpfiles = []
+        limiter.get().release(self._slot)
+        self._slot = None
+
+
+def transcode(filename, outfile, audiorange=None, quality=DEFAULT_QUALITY, background=False):
+    """Run `Transcoder` writing the result to `outfile`
+    """
+    stream = Transcoder(filename, audiorange, quality, background)
+    try:
+        with open(outfile, "wb") as f:
+            for block in stream:
+                f.write(block)
+    finally:
+        stream.close()
+
+def peaks_path(filename):
+    return "{}.peaks".format(filename)
+
+def derived_paths(filename):
+    """Files derived from `filename`: page index, peaks and renditions
+    """
+    renditions = [rendition_path(filename, quality) for quality in QUALITIES]
+    return [oggindex.index_path(filename), peaks_path(filename)] + renditions
+
+def remove_audio(filename):
+    """Remove `filename` and files derived from it
+    """
+    for path in [filename] + derived_paths(filename):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class Peaks(object):
+    """Multi-resolution waveform summary: per level, the (min, max) sample
+       value of consecutive blocks of `samplesperpeak[level]` samples.
+       Level 0 has `PEAKS_PER_SECOND` peaks per second and each next
+       level is `FACTOR` times coarser.
+    """
+    PEAKS_PER_SECOND = 100
+    FACTOR = 4
+    MIN_PEAKS = 256 #Smallest coarsest level
+    DEFAULT_BINS = 1000
+
+    def __init__(self, rate, samplesperpeak, levels):
+        self.rate = rate
+        self.samplesperpeak = samplesperpeak
+        self.levels = levels
+
+    @classmethod
+    def compute(cls, filename):
+        """Decode `filename` (mono 16-bit) in a single streaming pass
+        """
+        rate = oggindex.OggIndex.for_file(filename).rate
+        spp = max(rate // cls.PEAKS_PER_SECOND, 1)
+        blocksize = spp * 2 * 4096 #bytes, whole number of peaks
+        cmd = [SOX, filename, "-t", "raw", "-e", "signed-integer", "-b", "16", "-L", "-c", "1", "-"]
+        mins, maxs = [], []
+        with limiter.get().slot(background=True):
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            pending = b""
+            while True:
+                data = proc.stdout.read(blocksize)
+                if data:
+                    pending += data
+                    n = len(pending) // (2 * spp) * 2 * spp
+                else: #flush partial final peak
+                    n = len(pending) - len(pending) % 2
+                if n:
+                    samples = np.frombuffer(pending[:n], dtype="<i2")
+                    pending = pending[n:]
+                    npeaks = int(math.ceil(len(samples) / spp))
+                    samples = np.pad(samples, (0, npeaks * spp - len(samples)), mode="edge").reshape(npeaks, spp)
+                    mins.append(samples.min(axis=1))
+                    maxs.append(samples.max(axis=1))
+                if not data:
+                    break
+            stde = proc.stderr.read()
+            proc.wait()
+        if proc.returncode != 0:
+            LOG.error(stde)
+            raise RuntimeError("Cannot compute waveform peaks!")
+        level = np.column_stack([np.concatenate(mins or [np.zeros(0, "<i2")]),
+                                 np.concatenate(maxs or [np.zeros(0, "<i2")])])
+        levels = [level]
+        samplesperpeak = [spp]
+        while len(levels[-1]) >= cls.MIN_PEAKS * cls.FACTOR:
+            prev = levels[-1]
+            npeaks = int(math.ceil(len(prev) / cls.FACTOR))
+            prev = np.pad(prev, ((0, npeaks * cls.FACTOR - len(prev)), (0, 0)), mode="edge").reshape(npeaks, cls.FACTOR, 2)
+            levels.append(np.column_stack([prev[:, :, 0].min(axis=1), prev[:, :, 1].max(axis=1)]))
+            samplesperpeak.append(samplesperpeak[-1] * cls.FACTOR)
+        return cls(rate, samplesperpeak, levels)
+
+    def save(self, filename):
+        arrays = dict(("level{}".format(i), level.astype("<i2")) for i, level in enumerate(self.levels))
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=".peaks")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, rate=np.array([self.rate]), samplesperpeak=np.array(self.samplesperpeak), **arrays)
+            os.rename(tmpname, filename)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            samplesperpeak = [int(n) for n in data["samplesperpeak"]]
+            levels = [data["level{}".format(i)] for i in range(len(samplesperpeak))]
+            return cls(int(data["rate"][0]), samplesperpeak, levels)
+
+    def window(self, start, end, bins=None):
+        """Peaks covering `start` to `end` (seconds) from the coarsest level
+           that still provides at least `bins` peaks
+        """
+        if bins is None:
+            bins = self.DEFAULT_BINS
+        level = 0
+        for i, spp in enumerate(self.samplesperpeak):
+            if (end - start) * self.rate / spp >= bins:
+                level = i
+        spp = self.samplesperpeak[level]
+        first = max(int(math.floor(start * self.rate / spp)), 0)
+        last = int(math.ceil(end * self.rate / spp))
+        return {"start": first * spp / self.rate,
+                "samplerate": self.rate,
+                "samplesperpeak": spp,
+                "peaks": self.levels[level][first:last].tolist()}
+
+
+class SegmentCache(object):
+    """Content-addressed cache of transcoded audio segments, keyed by
+       source file identity, segment range (None for the whole file),
+       quality and `PIPELINE_VERSION`.
+
+       Entries are published with an atomic rename so that concurrent
+       workers never see partially written files and the total size is
+       kept below `maxsize` bytes by evicting the least recently used
+       entries (file mtime is refreshed on every hit).
+    """
+    SUFFIX = ".ogg"
+    STALE_TMP = 3600
+
+    def __init__(self, cachedir, maxsize):
+        self._cachedir = cachedir
+        self._maxsize = int(maxsize)
+        util.makedirs(self._cachedir)
+
+    def _path(self, filename, start, end, quality):
+        st = os.stat(filename)
+        if start is None:
+            segment = "full"
+        else:
+            segment = "{:.3f}:{:.3f}".format(float(start), float(end))
+        key = "{}:{}:{}:{}:{}:{}:{}".format(os.path.abspath(filename), st.st_ino, st.st_size, st.st_mtime,
+                                            segment, quality, PIPELINE_VERSION)
+        return os.path.join(self._cachedir, hashlib.sha1(key.encode("utf-8")).hexdigest() + self.SUFFIX)
+
+    def put(self, filename, start, end, render, quality=DEFAULT_QUALITY):
+        """Create cache entry: `render(outfile)` is expected to write the
+           segment to `outfile`. Returns the path of the entry.
+        """
+        path = self._path(filename, start, end, quality)
+        self._insert(path, render).close()
+        return path
+
+    def open(self, filename, start, end, render, quality=DEFAULT_QUALITY):
+        """Open the cached segment for reading, creating the entry as in
+           `put()` if missing. The returned file remains readable if the
+           entry is evicted by another worker.
+        """
+        path = self._path(filename, start, end, quality)
+        try:
+            f = open(path, "rb")
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return self._insert(path, render)
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass #evicted meanwhile
+        LOG.debug("Cache hit: {}".format(path))
+        return f
+
+    def _insert(self, path, render):
+        """Render and publish entry `path`, returns it opened for reading
+           (before it is published, so that it cannot be evicted first)
+        """
+        fd, tmpname = tempfile.mkstemp(dir=self._cachedir, prefix=".tmp")
+        os.close(fd)
+        try:
+            render(tmpname)
+            f = open(tmpname, "rb")
+            os.rename(tmpname, path)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        LOG.debug("Cache insert: {}".format(path))
+        self.evict()
+        return f
+
+    def evict(self):
+        """Remove least recently used entries until cache is below
+           `maxsize`. Only one worker evicts at a time, others skip.
+        """
+        with open(os.path.join(self._cachedir, ".lock"), "w") as lockfh:
+            try:
+                fcntl.flock(lockfh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            entries = []
+            total = 0
+            now = time.time()
+            for name in os.listdir(self._cachedir):
+                path = os.path.join(self._cachedir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.startswith(".tmp") and now - st.st_mtime > self.STALE_TMP:
+                    os.remove(path) #left behind by a killed worker
+                    continue
+                if not name.endswith(self.SUFFIX) or name.startswith("."):
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            if total <= self._maxsize:
+                return
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self._maxsize:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            LOG.info("Cache evicted to {} bytes".format(total))
+
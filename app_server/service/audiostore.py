@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Content-addressed store for uploaded audio. Each distinct recording
+   is kept once as `<storedir>/<sha256[:2]>/<sha256>` with its derived
+   files (page index, renditions, peaks, see `audio.derived_paths`).
+   Projects refer to a recording through hard links in the project
+   directory, so that the rest of the application keeps using
+   per-project paths while the data and precomputation are shared.
+
+   The link count of a blob is its reference count: a blob is removed
+   by `release()` once no project links to it any more.
+"""
+from __future__ import unicode_literals, division, print_function #Py2
+
+import os
+import fcntl
+import hashlib
+import logging
+from contextlib import contextmanager
+
+import audio
+import util
+
+LOG = logging.getLogger("APP.AUDIOSTORE")
+
+BLOCKSIZE = 1024 * 1024
+
+def sha256_file(filename):
+    """Return size and SHA-256 hex digest of `filename`
+    """
+    h = hashlib.sha256()
+    size = 0
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(BLOCKSIZE), b""):
+            h.update(block)
+            size += len(block)
+    return size, h.hexdigest()
+
+def _replace_with_link(src, dest):
+    """Atomically make `dest` a hard link to `src`
+    """
+    tmpname = "{}.tmp{}".format(dest, os.getpid())
+    if os.path.exists(tmpname):
+        os.remove(tmpname)
+    os.link(src, tmpname)
+    os.rename(tmpname, dest)
+
+
+class AudioStore(object):
+    def __init__(self, storedir):
+        self._storedir = storedir
+
+    def path(self, digest):
+        return os.path.join(self._storedir, digest[:2], digest)
+
+    @contextmanager
+    def lock(self, digest):
+        """Serialise work on blob `digest` across workers
+        """
+        blob = self.path(digest)
+        util.makedirs(os.path.dirname(blob))
+        with open("{}.lock".format(blob), "w") as lockfh:
+            fcntl.flock(lockfh, fcntl.LOCK_EX)
+            yield blob
+
+    def add(self, filename, digest):
+        """Add `filename` with SHA-256 `digest` to the store (must hold
+           `lock`). If the content is already stored `filename` is
+           replaced by a link to the existing blob. Returns the blob path.
+        """
+        blob = self.path(digest)
+        if os.path.exists(blob):
+            LOG.info("Duplicate audio {}: linking {}".format(digest, filename))
+            _replace_with_link(blob, filename)
+        else:
+            os.link(filename, blob)
+        return blob
+
+    def link_derived(self, blob, filename):
+        """Link derived files of `blob` to the corresponding paths of
+           `filename`
+        """
+        for src, dest in zip(audio.derived_paths(blob), audio.derived_paths(filename)):
+            if os.path.exists(src):
+                _replace_with_link(src, dest)
+
+    def release(self, digest):
+        """Remove blob `digest` (and derived files) if no longer linked
+           to from any project
+        """
+        if not digest:
+            return
+        with self.lock(digest) as blob:
+            try:
+                nlink = os.stat(blob).st_nlink
+            except OSError:
+                return
+            if nlink <= 1:
+                LOG.info("Removing unreferenced audio {}".format(digest))
+                audio.remove_audio(blob)
@@ -13,9 +13,12 @@ import random
 import json
 import time
 import uuid, base64
+import hmac
+import hashlib
 import logging
 import os
 import smtplib
+import threading
 
 try:
     from sqlite3 import dbapi2 as sqlite
@@ -28,6 +31,10 @@ from httperrs import NotAuthorizedError, ConflictError
 
 LOG = logging.getLogger("APP.AUTH")
 
+TOKCACHE_TTL = 10.0 #seconds a token lookup is served from memory
+TOKCACHE_CHECK = 1.0 #seconds between checks for invalidations by other workers
+TOKCACHE_RECHECK = 60.0 #seconds between checks whether a DB without `authgen` was upgraded
+
 def gen_pw(length=7):
     alphabet = string.ascii_letters + string.digits + '!@#$%^&*()'
     return "".join(random.choice(alphabet) for i in range(length))
@@ -40,6 +47,149 @@ def hash_pw(password):
     pwhash = bcrypt.hashpw(password, salt)
     return salt, pwhash
 
+def sweep_tokens(authdb):
+    """Remove expired tokens from auth DB file `authdb`, returns the
+       number removed
+    """
+    with sqlite.connect(authdb) as db_conn:
+        return db_conn.execute("DELETE FROM tokens WHERE ? > expiry", (time.time(),)).rowcount
+
+
+class TokenSigner(object):
+    """Issues and verifies stateless tokens: username, role, expiry and
+       issue time signed with HMAC-SHA256 under `key`, so that they can
+       be verified without a DB lookup. Signed tokens are still recorded
+       in `tokens` at login; removing them there revokes them through
+       the `revoked` table (see tools/authdb.py and `TokenCache`).
+    """
+    def __init__(self, key):
+        self._key = key.encode("utf-8")
+
+    def _mac(self, payload):
+        return base64.urlsafe_b64encode(hmac.new(self._key, payload, hashlib.sha256).digest())
+
+    def sign(self, username, role, expiry):
+        claims = {"u" : username, "r" : role, "e" : expiry, "i" : time.time(), "n" : uuid.uuid4().hex[:8]}
+        payload = base64.urlsafe_b64encode(json.dumps(claims, separators=(",", ":")))
+        return "{}.{}".format(payload, self._mac(payload))
+
+    def verify(self, token):
+        """Returns the claims of a validly signed `token`, else None
+        """
+        try:
+            payload, sep, mac = token.encode("ascii").partition(b".")
+        except UnicodeError:
+            return None
+        if not sep or not hmac.compare_digest(self._mac(payload), mac):
+            return None
+        return json.loads(base64.urlsafe_b64decode(payload))
+
+
+def is_signed(token):
+    return "." in token #opaque tokens are base64 without padding dots
+
+
+class TokenCache(object):
+    """Per-process cache of valid tokens of one auth DB: entries are
+       served for at most `ttl` seconds. Changes in other processes
+       (logout, user deletion, role changes) are detected through the
+       generation counter in the DB's `authgen` table (maintained by
+       triggers, see tools/authdb.py), read at most every `check`
+       seconds. The revocation list for signed tokens is reloaded when
+       the generation changes. The cache is not used while the DB has no
+       `authgen` table, which is looked for again every `recheck`
+       seconds.
+    """
+    def __init__(self, ttl=TOKCACHE_TTL, check=TOKCACHE_CHECK, recheck=TOKCACHE_RECHECK):
+        self._ttl = ttl
+        self._check = check
+        self._recheck = recheck
+        self._lock = threading.Lock()
+        self._entries = {} #token -> (username, roles, expiry, cached until)
+        self._revoked = None #username -> time before which signed tokens are revoked
+        self._generation = None
+        self._checked = 0.0
+        self._disabled_until = None #set while the DB is not upgraded
+
+    def sync(self, db):
+        """Drop all entries if the generation of `db` changed, returns
+           whether the cache can be used
+        """
+        now = time.time()
+        if self._disabled_until is not None and now < self._disabled_until:
+            return False
+        if now - self._checked < self._check:
+            return True
+        with self._lock:
+            if now - self._checked < self._check: #synced by another thread
+                return True
+            try:
+                generation = db.execute("SELECT generation FROM authgen").fetchone()[0]
+            except sqlite.OperationalError as e:
+                if self._disabled_until is None:
+                    LOG.warning("Token cache disabled, upgrade the auth DB with tools/authdb.py --upgrade ({})".format(e))
+                self._disabled_until = now + self._recheck
+                return False
+            if self._disabled_until is not None:
+                LOG.info("Token cache enabled: auth DB upgraded")
+                self._disabled_until = None
+            if generation != self._generation:
+                #Read after the generation: a concurrent change at worst
+                #pairs a newer list with the older generation (reloaded
+                #on the next check)
+                try:
+                    revoked = dict((row[0], row[1]) for row in db.execute("SELECT username, before FROM revoked").fetchall())
+                except sqlite.OperationalError:
+                    revoked = None #DB not upgraded: signed tokens are looked up in the DB
+                self._entries = {}
+                self._revoked = revoked
+                self._generation = generation
+            self._checked = now
+        return True
+
+    def revoked(self, username, issued):
+        """Whether signed tokens of `username` issued at time `issued`
+           may have been revoked
+        """
+        revoked = self._revoked
+        return revoked is None or issued <= revoked.get(username, 0.0)
+
+    def get(self, token):
+        """Returns (username, roles, expiry) or None
+        """
+        entry = self._entries.get(token)
+        if entry is None or time.time() > entry[3]:
+            return None
+        return entry[:3]
+
+    def put(self, token, username, roles, expiry):
+        with self._lock:
+            self._entries[token] = (username, roles, expiry, time.time() + self._ttl)
+
+    def invalidate(self, token=None, username=None):
+        """Drop `token` or all tokens of `username` (in this process)
+        """
+        with self._lock:
+            self._entries.pop(token, None)
+            if username is not None:
+                self._entries = dict((k, v) for k, v in self._entries.items() if v[0] != username)
+
+
+_token_caches = {}
+_token_caches_lock = threading.Lock()
+
+def token_cache(authdb, ttl=TOKCACHE_TTL):
+    """The process's TokenCache for auth DB file `authdb` with entry
+       lifetime `ttl` (services configured with different lifetimes
+       each get their own cache)
+    """
+    key = (authdb, float(ttl))
+    with _token_caches_lock:
+        if key not in _token_caches:
+            _token_caches[key] = TokenCache(ttl)
+        return _token_caches[key]
+
+
 class UserAuth(object):
     def __init__(self, config_file=None):
         if config_file is not None:
@@ -48,19 +198,20 @@ class UserAuth(object):
             #DB connection setup:
             self.authdb = sqlite.connect(self._config["authdb"], factory=AuthDB)
             self.authdb.row_factory = sqlite.Row
+            self.authdb.cache = token_cache(self._config["authdb"], self._config.get("tokcache_ttl", TOKCACHE_TTL))
+            if self._config.get("tokenkey"):
+                self.authdb.signer = TokenSigner(self._config["tokenkey"])
 
     def login(self, request):
         """Validate provided username and password and insert new token into
            tokens and return if successful.  We also use this
-           opportunity to clear stale tokens.
+           opportunity to clear the user's stale tokens (others are
+           removed periodically, see `sweep_tokens()`).
              - The DB/service actually logged into is determined by
                the service as setup in the dispatcher
         """
         with sqlite.connect(self._config["authdb"]) as db_conn:
-            #REMOVE STALE TOKENS
             db_curs = db_conn.cursor()
-            db_curs.execute("DELETE FROM tokens WHERE ? > expiry", (time.time(),))
-            db_conn.commit()
             #PROCEED TO AUTHENTICATE USER
             db_curs.execute("SELECT * FROM users WHERE username=?", (request["username"],))
             entry = db_curs.fetchone()
@@ -82,17 +233,23 @@ class UserAuth(object):
                 roles = role.split(";")
                 if request["role"] not in roles:
                     raise ConflictError("User cannot take this role")
+            #REMOVE STALE TOKENS
+            db_curs.execute("DELETE FROM tokens WHERE username=? AND ? > expiry", (username, time.time()))
             #User already logged in?
             db_curs.execute("SELECT * FROM tokens WHERE username=?", (username,))
             entry = db_curs.fetchone()
             if not entry is None:
                 raise ConflictError("User already logged in")
             #All good, create new token, remove tmppwhash
-            token = gen_token()
+            expiry = time.time() + self._config["toklife"]
+            if self.authdb.signer is not None:
+                token = self.authdb.signer.sign(username, request["role"], expiry)
+            else:
+                token = gen_token()
             # Assign role based on request URI
             db_curs.execute("INSERT INTO tokens (token, username, role, expiry) VALUES(?,?,?,?)", (token,
                                                                                            username, request["role"],
-                                                                                           time.time() + self._config["toklife"]))
+                                                                                           expiry))
             db_curs.execute("UPDATE users SET tmppwhash=? WHERE username=?", (None, username))
         LOG.info("User login: {}".format(request["username"]))
         return {"token": token, "templogin": templogin}
@@ -105,19 +262,16 @@ class UserAuth(object):
         with sqlite.connect(self._config["authdb"]) as db_conn:
             db_curs = db_conn.cursor()
             db_curs.execute("DELETE FROM tokens WHERE token=?",  (request["token"],))
+        self.authdb.invalidate(token=request["token"])
         LOG.info("User logout: {}".format(username))
         return "User logged out"
 
     def logout2(self, request):
         """Validate provided username and password and remove token associated
-           with this user if successful.  We also use this opportunity
-           to clear stale tokens.
+           with this user if successful.
         """
         with sqlite.connect(self._config["authdb"]) as db_conn:
-            #REMOVE STALE TOKENS
             db_curs = db_conn.cursor()
-            db_curs.execute("DELETE FROM tokens WHERE ? > expiry", (time.time(),))
-            db_conn.commit()
             #PROCEED TO AUTHENTICATE USER
             db_curs.execute("SELECT * FROM users WHERE username=?", (request["username"],))
             entry = db_curs.fetchone()
@@ -136,6 +290,7 @@ class UserAuth(object):
                         raise NotAuthorizedError("Wrong credentials")
             #logout
             db_curs.execute("DELETE FROM tokens WHERE username=?", (username,))
+        self.authdb.invalidate(username=username)
         LOG.info("User logout: {}".format(username))
         return "User logged out"
 
@@ -190,10 +345,31 @@ class UserAuth(object):
 
 
 class AuthDB(sqlite.Connection):
+    cache = None #TokenCache, see UserAuth
+    signer = None #TokenSigner, if signed tokens are enabled
+
     def authenticate(self, token, role):
         """Checks whether token is valid/existing in authdb and returns associated
-           username or raises NotAuthorizedError
+           username or raises NotAuthorizedError. Valid tokens are served
+           from `cache` if set, signed tokens are verified without a
+           lookup if `signer` is set.
         """
+        cached = self.cache is not None and self.cache.sync(self)
+        if self.signer is not None and is_signed(token):
+            claims = self.signer.verify(token)
+            if claims is None: #forged, or signed with a previous key
+                raise NotAuthorizedError("Invalid token signature!")
+            if (cached and time.time() <= claims["e"] and role in claims["r"].split(";") and
+                not self.cache.revoked(claims["u"], claims["i"])):
+                return claims["u"]
+            #else: expired or possibly revoked, handled below
+        if cached:
+            entry = self.cache.get(token)
+            if entry is not None:
+                username, roles, expiry = entry
+                if role in roles and time.time() <= expiry:
+                    return username
+                #else: expired or role mismatch handled below
         with self:
             entry = self.execute("SELECT * FROM tokens WHERE token=?", (token,)).fetchone()
             if entry is None:
@@ -207,9 +383,17 @@ class AuthDB(sqlite.Connection):
                 elif role not in roles:
                     self.execute("DELETE FROM tokens WHERE token=?", (token,)) #remove expired token
                     raise NotAuthorizedError("Permission denied based on role!")
-
+        if cached:
+            self.cache.put(token, entry["username"], roles, entry["expiry"])
         return entry["username"]
 
+    def invalidate(self, token=None, username=None):
+        """Drop cached `token` or tokens of `username` after removing
+           them (other processes notice through the DB generation)
+        """
+        if self.cache is not None:
+            self.cache.invalidate(token, username)
+
     ### TODO
 
 
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Simple per-process background job queue. Jobs are run one at a time,
+   in order of submission, by a daemon thread started on first use in
+   each (uWSGI worker) process -- requires uWSGI `--enable-threads`.
+
+   Jobs are not persisted: a job is lost if its worker is restarted, so
+   callers should record progress where it can be inspected (e.g. in
+   the DB) and be able to recover from unfinished jobs.
+"""
+from __future__ import unicode_literals, division, print_function #Py2
+
+import os
+import threading
+import Queue
+import logging
+
+LOG = logging.getLogger("APP.BACKGROUND")
+
+_queue = Queue.Queue()
+_lock = threading.Lock()
+_thread = None
+_pid = None
+
+def _worker():
+    while True:
+        func, args, kwargs = _queue.get()
+        try:
+            LOG.debug("Running job: {}".format(func.__name__))
+            func(*args, **kwargs)
+        except Exception as e:
+            LOG.exception("Background job {} failed: {}".format(func.__name__, e))
+        finally:
+            _queue.task_done()
+
+def submit(func, *args, **kwargs):
+    """Queue `func(*args, **kwargs)` to be run in the background
+    """
+    global _thread, _pid
+    with _lock:
+        if _thread is None or _pid != os.getpid() or not _thread.is_alive():
+            _pid = os.getpid()
+            _thread = threading.Thread(target=_worker, name="background")
+            _thread.daemon = True
+            _thread.start()
+    _queue.put((func, args, kwargs))
+    LOG.debug("Queued job: {} (queue size {})".format(func.__name__, _queue.qsize()))
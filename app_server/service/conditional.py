@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Validators for conditional requests: ETag and Last-Modified values
+   and evaluation of `If-None-Match`/`If-Modified-Since` request headers
+   (answered with "304 Not Modified", see `httperrs.NotModifiedError`).
+
+   Dispatch passes the request's conditional headers to service methods
+   under `REQUEST_KEY` so that they can be checked against cheap
+   validators (e.g. a task's commit ID) before any data is read.
+"""
+from __future__ import unicode_literals, division, print_function #Py2
+
+import os
+import hashlib
+import email.utils
+
+from httperrs import NotModifiedError
+
+REQUEST_KEY = "_conditional"
+
+def make_etag(*parts):
+    """Strong entity tag from the identifying `parts` of a representation
+    """
+    key = ":".join("{}".format(part) for part in parts)
+    return '"{}"'.format(hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+def weak(etag):
+    """Weak form of entity tag `etag`, e.g. for a response that may be
+       sent in different content-codings (which must not share a strong
+       entity tag)
+    """
+    return etag if etag.startswith("W/") else "W/{}".format(etag)
+
+def file_validators(filename, *parts):
+    """ETag and Last-Modified time of (a representation derived from)
+       `filename` from its inode, size and mtime, i.e. without reading it
+    """
+    st = os.stat(filename)
+    return make_etag(st.st_ino, st.st_size, st.st_mtime, *parts), st.st_mtime
+
+def http_date(timestamp):
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+def from_env(env):
+    """Conditional request headers in WSGI `env`, None if there are none
+    """
+    headers = {}
+    if "HTTP_IF_NONE_MATCH" in env:
+        headers["ifnonematch"] = env["HTTP_IF_NONE_MATCH"]
+    if "HTTP_IF_MODIFIED_SINCE" in env:
+        headers["ifmodifiedsince"] = env["HTTP_IF_MODIFIED_SINCE"]
+    return headers or None
+
+def is_fresh(headers, etag, lastmodified=None):
+    """Whether the client's copy (described by conditional request
+       `headers`) is current. If-None-Match takes precedence over
+       If-Modified-Since.
+    """
+    if not headers:
+        return False
+    if "ifnonematch" in headers:
+        tags = [tag.strip() for tag in headers["ifnonematch"].split(",")]
+        if "*" in tags:
+            return True
+        tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags] #weak comparison
+        return (etag[2:] if etag.startswith("W/") else etag) in tags
+    if "ifmodifiedsince" in headers and lastmodified is not None:
+        since = email.utils.parsedate_tz(headers["ifmodifiedsince"])
+        if since is None:
+            return False
+        return int(lastmodified) <= email.utils.mktime_tz(since)
+    return False
+
+def check(request, etag, lastmodified=None):
+    """Raise `NotModifiedError` if the client sent matching conditional
+       headers with `request`
+    """
+    if is_fresh(request.get(REQUEST_KEY), etag, lastmodified):
+        raise NotModifiedError(etag, lastmodified)
+
+def headers(etag, lastmodified=None):
+    """Response headers for validators
+    """
+    response_header = [("ETag", str(etag))]
+    if lastmodified is not None:
+        response_header.append(("Last-Modified", str(http_date(lastmodified))))
+    return response_header
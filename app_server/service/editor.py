@@ -14,6 +14,7 @@ import codecs
 import string
 import tempfile
 import subprocess
+import threading
 from functools import wraps
 from types import FunctionType
 import unicodedata
@@ -26,12 +27,21 @@ except ImportError:
 import auth
 import admin
 import repo
+import audio
+import limiter
+import background
+import conditional
+import applog
 from httperrs import *
 
 LOG = logging.getLogger("APP.EDITOR")
 SPEECHSERVER = os.getenv("SPEECHSERVER"); assert SPEECHSERVER is not None
 APPSERVER = os.getenv("APPSERVER"); assert APPSERVER is not None
 
+#Audio files with waveform peaks being computed in this process
+PEAKS_PENDING = set()
+PEAKS_LOCK = threading.Lock()
+
 def authlog(okaymsg):
     """This performs authentication (inserting `username` into function
        namespace) and logs the ENTRY, FAILURE or OK return of the
@@ -43,11 +53,8 @@ def authlog(okaymsg):
         @wraps(f)
         def wrapper(*args, **kw):
             self, request = args[:2]
-            if not "file" in request:
-                LOG.debug("ENTER: request={}".format(request), extra=logfuncname)
-            else:
-                LOG.debug("ENTER: without 'file' --> request={}".format(
-                    dict([(k, request[k]) for k in request if k != "file"])), extra=logfuncname)
+            if LOG.isEnabledFor(logging.DEBUG):
+                LOG.debug("ENTER: request={}".format(applog.redact(request)), extra=logfuncname)
             try:
                 #AUTH + INSERT USERNAME INTO FUNC SCOPE
                 username = self.authdb.authenticate(request["token"], self._role)
@@ -142,9 +149,14 @@ class Editor(auth.UserAuth):
     @authlog("Return audio")
     def get_audio(self, request):
         """
-            Return the audio for this specific task
+            Return the audio for this specific task, optionally in a lower
+            `quality` rendition
         """
         try:
+            quality = request.get("quality", audio.DEFAULT_QUALITY)
+            if quality not in audio.QUALITIES:
+                raise BadRequestError("Unknown audio quality: {}".format(quality))
+
             with self.db as db:
                 db.check_project_task(request["projectid"], request["taskid"], check_err=True)
 
@@ -161,17 +173,72 @@ class Editor(auth.UserAuth):
 
                 self._test_read(audiofile)
 
-                items = db.get_task_field(request["projectid"], request["taskid"], year, fields=["start", "end"])
+                try:
+                    items = db.get_task_field(request["projectid"], request["taskid"], year, fields=["start", "end", "textfile", "audiostatus"])
+                except sqlite.OperationalError: #Task table not upgraded (tools/projectdb.py --upgrade): cut on the fly
+                    items = db.get_task_field(request["projectid"], request["taskid"], year, fields=["start", "end", "textfile"])
                 if not items:
                     raise BadRequestError("Audio segment has not been defined for this task")
 
+                #Pre-rendered at task assignment?
+                if items.get("audiostatus") == "done":
+                    taskaudio = audio.task_audio_path(os.path.dirname(items["textfile"]), quality)
+                    if os.path.exists(taskaudio):
+                        return {"filename" : taskaudio, "mime" : "audio/ogg", "normalized" : True}
+                    LOG.warning("Pre-rendered task audio missing: {}".format(taskaudio))
+
                 audiorange = [float(items["start"]), float(items["end"])]
 
-            return {"filename" : audiofile, "range" : audiorange, "mime" : "audio/ogg"}
+            return {"filename" : audiofile, "range" : audiorange, "quality" : quality, "mime" : "audio/ogg"}
         except Exception as e:
             LOG.error("Get audio failed: {}".format(e))
             raise
 
+    @authlog("Return waveform peaks")
+    def get_peaks(self, request):
+        """
+            Return waveform peaks for this specific task, optionally
+            restricted to `start`-`end` (seconds, within the task) and
+            reduced to about `bins` peaks. Conflict if the peaks are still
+            being computed (retry later).
+        """
+        try:
+            with self.db as db:
+                db.check_project_task(request["projectid"], request["taskid"], check_err=True)
+
+            with self.db as db:
+                project = db.get_project(request["projectid"], fields=["year", "audiofile"])
+                year = project["year"]
+                audiofile = project["audiofile"]
+
+                if audiofile is None or len(audiofile) == 0:
+                    raise NotFoundError("No audio file has been uploaded to the project")
+
+                items = db.get_task_field(request["projectid"], request["taskid"], year, fields=["start", "end"])
+                if not items:
+                    raise BadRequestError("Audio segment has not been defined for this task")
+
+            try:
+                start = max(float(request.get("start", items["start"])), float(items["start"]))
+                end = min(float(request.get("end", items["end"])), float(items["end"]))
+                bins = int(request["bins"]) if "bins" in request else None
+            except ValueError:
+                raise BadRequestError("Parameters start, end and bins must be numbers")
+            if end <= start or (bins is not None and bins <= 0):
+                raise BadRequestError("Invalid peaks window")
+
+            peaksfile = audio.peaks_path(audiofile)
+            if not os.path.exists(peaksfile): #Uploaded before peaks were computed
+                with PEAKS_LOCK:
+                    if audiofile not in PEAKS_PENDING:
+                        PEAKS_PENDING.add(audiofile)
+                        background.submit(compute_peaks, audiofile)
+                raise ConflictError("Waveform peaks are being computed, please retry later")
+            return audio.Peaks.load(peaksfile).window(start, end, bins)
+        except Exception as e:
+            LOG.error("Get peaks failed: {}".format(e))
+            raise
+
     @authlog("Return text")
     def get_text(self, request):
         """
@@ -183,11 +250,17 @@ class Editor(auth.UserAuth):
 
             with self.db as db:
                 year = db.get_project(request["projectid"], fields=["year"])["year"]
-                textfile = db.get_task_field(request["projectid"], request["taskid"], year, fields=["textfile"])["textfile"]
+                task = db.get_task_field(request["projectid"], request["taskid"], year, fields=["textfile", "commitid", "modified"])
+                textfile = task["textfile"]
 
                 if textfile is None or len(textfile) == 0:
                     raise NotFoundError("This task has no text file")
 
+                #Every change to the text is committed: the commit identifies the content
+                #(weak: the JSON response may be compressed)
+                etag = conditional.weak(conditional.make_etag(textfile, task["commitid"], task["modified"]))
+                conditional.check(request, etag, task["modified"])
+
                 if not os.path.exists(textfile):
                     raise NotFoundError("Cannot find text file")
 
@@ -195,7 +268,9 @@ class Editor(auth.UserAuth):
 
                 with codecs.open(textfile, "r", "utf-8") as f: text = f.read()
 
-            return {"text" : text}
+            return {"text" : text, "etag" : etag, "lastmodified" : task["modified"]}
+        except NotModifiedError:
+            raise
         except Exception as e:
             LOG.error("Get text failed: {}".format(e))
             raise
@@ -465,7 +540,7 @@ class Editor(auth.UserAuth):
                 LOG.debug(row)
                 #URL exists?
                 if not row:
-                    raise MethodNotAllowedError(uri)
+                    raise NotFoundError(uri)
                 LOG.info("Returning data for project ID: {}".format(row["projectid"]))
                 projectname = db.get_project(row["projectid"], fields=["projectname"])["projectname"]
 
@@ -476,8 +551,15 @@ class Editor(auth.UserAuth):
                         return {"mime": "text/html", "filename": row["audiofile"], "savename" : "{}.html".format(self._unicode_to_ascii(projectname)), "delete" : "N"}
                     elif float(row["start"]) == -1.0 and float(row["end"]) == -1.0: # Masterfile MS-WORD document
                         LOG.info("Returning MS-WORD document")
+                        #Built from the task texts: their commits identify the content
+                        #(weak: pandoc output may differ between builds)
+                        commits = db.get_project_commits(row["projectid"])
+                        etag = conditional.weak(conditional.make_etag(row["projectid"],
+                                                                      *["{}:{}:{}".format(*commit) for commit in commits]))
+                        modified = [commit[2] for commit in commits if commit[2] is not None]
                         return {"mime": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                                "filename": row["audiofile"], "savename" : "{}.docx".format(self._unicode_to_ascii(projectname)), "delete" : "Y"}
+                                "filename": row["audiofile"], "savename" : "{}.docx".format(self._unicode_to_ascii(projectname)), "delete" : "Y",
+                                "etag" : etag, "lastmodified" : max(modified) if modified else None}
                     else:# Normal audio
                         LOG.info("Returning ranged audio")
                         return {"mime": "audio/ogg", "filename": row["audiofile"], "range" : (float(row["start"]), float(row["end"]))}
@@ -486,6 +568,7 @@ class Editor(auth.UserAuth):
                     return {"mime": "audio/ogg", "filename": row["audiofile"]}
         except Exception as e:
             LOG.error("Requested outgoing resource failed: {}".format(e))
+            raise
 
     def _unicode_to_ascii(self, text):
         """ Remove non-ascii characters
@@ -496,13 +579,13 @@ class Editor(auth.UserAuth):
         """ Processing incoming data and save to task
         """
         try:
-            LOG.debug("incoming_data: {}".format(data))
+            LOG.debug("incoming_data: {}".format(applog.redact(data)))
             with self.db as db:
                 row = db.get_incoming(uri)
                 LOG.debug(row)
                 #URL exists?
                 if not row:
-                    raise MethodNotAllowedError(uri)
+                    raise NotFoundError(uri)
 
                 #if not row["servicetype"] in self._config["speechservices"]["services"]:
                 #    raise Exception("Service type '{}' not defined in AppServer".format(row["servicetype"]))
@@ -513,6 +596,7 @@ class Editor(auth.UserAuth):
             return "Request successful!"
         except Exception as e:
             LOG.error("Request incoming resource failed: {}".format(e))
+            raise
 
     def _incoming_base(self, data, projectid, taskid, service_name):
         """
@@ -693,23 +777,29 @@ class Editor(auth.UserAuth):
                         all_text.append(text)
 
                 all_text = u"\n".join(all_text)
-                LOG.info(all_text)
+                LOG.info("Master document: {} characters".format(len(all_text)))
                 _html = tempfile.NamedTemporaryFile(delete=False)
-                with codecs.open(_html.name, "w", "utf-8") as f:
-                    f.write(all_text)
-
+                _html.close()
                 _docx = tempfile.NamedTemporaryFile(delete=False)
                 _docx.close()
-
-                cmd = "pandoc -f html -t docx -o {} {}".format(_docx.name, _html.name)
-                ps = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                stdout, stderr = ps.communicate()
-                LOG.info(stdout)
-                LOG.error(stderr)
-
-                outurl = auth.gen_token()
-                db.insert_outgoing(request["projectid"], outurl, _docx.name, "-1.0", "-1.0")
-                os.remove(_html.name)
+                try:
+                    with codecs.open(_html.name, "w", "utf-8") as f:
+                        f.write(all_text)
+
+                    cmd = "pandoc -f html -t docx -o {} {}".format(_docx.name, _html.name)
+                    with limiter.get().slot():
+                        ps = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                        stdout, stderr = ps.communicate()
+                    LOG.info(stdout)
+                    LOG.error(stderr)
+
+                    outurl = auth.gen_token()
+                    db.insert_outgoing(request["projectid"], outurl, _docx.name, "-1.0", "-1.0")
+                except:
+                    os.remove(_docx.name) #e.g. server busy
+                    raise
+                finally:
+                    os.remove(_html.name)
             return {"url" : outurl}
 
         except Exception as e:
@@ -822,6 +912,13 @@ class EditorDB(sqlite.Connection):
             row = {}
         return row
 
+    def get_project_commits(self, projectid):
+        """(taskid, commitid, modified) of the project's tasks in task order
+        """
+        year = self.get_project(projectid, fields=["year"])["year"]
+        query = "SELECT taskid, commitid, modified FROM T{} WHERE projectid=? ORDER BY taskid".format(year)
+        return [tuple(row) for row in self.execute(query, (projectid,)).fetchall()]
+
     def get_all_tasks(self, this_user, mode="editor"):
         # Fetch all the projects which have been assigned
         if mode == "editor":
@@ -931,6 +1028,19 @@ class EditorDB(sqlite.Connection):
         return row
 
 
+def compute_peaks(audiofile):
+    """Background job: compute waveform peaks of `audiofile` (uploaded
+       before peaks were computed at ingest)
+    """
+    try:
+        peaksfile = audio.peaks_path(audiofile)
+        if not os.path.exists(peaksfile): #computed by another worker
+            audio.Peaks.compute(audiofile).save(peaksfile)
+            LOG.info("Computed waveform peaks: {}".format(peaksfile))
+    finally:
+        with PEAKS_LOCK:
+            PEAKS_PENDING.discard(audiofile)
+
 class PrevJobError(Exception):
     pass
 
@@ -39,3 +39,20 @@ class TeapotError(Exception):
     """
     pass
 
+
+class ServiceUnavailableError(Exception):
+    """ Intended to map to "HTTP 503 Service Unavailable", `retryafter`
+        (seconds) is sent in the Retry-After header
+    """
+    def __init__(self, message, retryafter=None):
+        Exception.__init__(self, message)
+        self.retryafter = retryafter
+
+class NotModifiedError(Exception):
+    """ Intended to map to "HTTP 304 Not Modified", carries the
+        validators (`etag`, `lastmodified`) of the current representation
+    """
+    def __init__(self, etag, lastmodified=None):
+        Exception.__init__(self, "Not modified")
+        self.etag = etag
+        self.lastmodified = lastmodified
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Admission control for CPU-heavy subprocess pipelines (SoX, pandoc)
+   shared by all uWSGI workers: at most `slots` pipelines run at a time
+   and at most `queue` requests wait for a slot. Requests that find the
+   queue full, or wait longer than `timeout` seconds, are refused with
+   `ServiceUnavailableError` (HTTP 503 with Retry-After).
+
+   Slots and queue places are lock files held with `flock`, so they are
+   released by the kernel if a worker dies. Background jobs wait for a
+   slot without taking a queue place and are never refused.
+"""
+from __future__ import unicode_literals, division, print_function #Py2
+
+import os
+import time
+import fcntl
+import random
+import tempfile
+import logging
+import multiprocessing
+from contextlib import contextmanager
+
+import util
+from httperrs import ServiceUnavailableError
+
+LOG = logging.getLogger("APP.LIMITER")
+
+POLL_INTERVAL = 0.05
+
+class Limiter(object):
+    """By default one slot per CPU and a queue of twice that
+    """
+    def __init__(self, lockdir=None, slots=None, queue=None, timeout=30.0, retryafter=5):
+        self._lockdir = lockdir or os.path.join(tempfile.gettempdir(), "stp-limiter")
+        self._slots = int(slots or multiprocessing.cpu_count())
+        self._queue = self._slots * 2 if queue is None else int(queue)
+        self._timeout = float(timeout)
+        self._retryafter = int(retryafter)
+        util.makedirs(self._lockdir)
+
+    def _try_lock(self, names):
+        """Lock the first available of lock files `names`, returns the
+           open file or None
+        """
+        names = list(names)
+        random.shuffle(names) #spread contention
+        for name in names:
+            fh = open(os.path.join(self._lockdir, name), "a")
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fh
+            except IOError:
+                fh.close()
+        return None
+
+    def _try_slot(self):
+        return self._try_lock("slot{}".format(i) for i in range(self._slots))
+
+    def acquire(self, background=False):
+        """Wait for a slot, returns a handle to pass to `release()`
+        """
+        slot = self._try_slot()
+        if slot is not None:
+            return slot
+        if background:
+            while slot is None:
+                time.sleep(POLL_INTERVAL)
+                slot = self._try_slot()
+            return slot
+        place = self._try_lock("queue{}".format(i) for i in range(self._queue))
+        if place is None:
+            LOG.warning("Saturated: queue full")
+            raise ServiceUnavailableError("Server busy, please retry later", self._retryafter)
+        try:
+            deadline = time.time() + self._timeout
+            while slot is None:
+                if time.time() > deadline:
+                    LOG.warning("Saturated: timed out waiting for a slot")
+                    raise ServiceUnavailableError("Server busy, please retry later", self._retryafter)
+                time.sleep(POLL_INTERVAL)
+                slot = self._try_slot()
+            return slot
+        finally:
+            place.close()
+
+    def release(self, slot):
+        if slot is not None:
+            slot.close() #also releases the lock
+
+    @contextmanager
+    def slot(self, background=False):
+        slot = self.acquire(background)
+        try:
+            yield
+        finally:
+            self.release(slot)
+
+
+_limiter = util.ProcessGlobal(Limiter)
+configure = _limiter.configure
+get = _limiter.get
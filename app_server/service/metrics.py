@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Request metrics: per-route latency histograms, request/response byte
+   counts and in-flight requests, exposed in the Prometheus text format.
+
+   Each worker process accumulates its own counters and periodically
+   (at most every `interval` seconds) writes a snapshot to
+   `<metricsdir>/worker<id>.json`. `collect()` sums the snapshots of all
+   workers, so that any worker can answer a scrape.
+"""
+from __future__ import unicode_literals, division, print_function #Py2
+
+import os
+import json
+import glob
+import time
+import tempfile
+import logging
+import threading
+
+import util
+
+LOG = logging.getLogger("APP.METRICS")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+ROUTE_KEY = "stp.route" #WSGI environ key for the route label, set by Dispatch
+UNMATCHED = "<unmatched>"
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values):
+    return ",".join('{}="{}"'.format(name, _escape("{}".format(value))) for name, value in zip(names, values))
+
+
+class Metrics(object):
+    def __init__(self, metricsdir=None, buckets=None, interval=5.0):
+        self._metricsdir = metricsdir or os.path.join(tempfile.gettempdir(), "stp-metrics")
+        self._buckets = sorted(float(b) for b in (buckets or DEFAULT_BUCKETS))
+        self._interval = float(interval)
+        self._lock = threading.Lock()
+        self._requests = {} #(method, route, status) -> [bucket counts..., count, sum, request bytes, response bytes]
+        self._inflight = {} #method -> count
+        self._gauges = {} #name -> (help, callable)
+        self._flushed = 0.0
+        util.makedirs(self._metricsdir)
+
+    def clear(self):
+        """Remove the snapshots of all workers, e.g. at server start
+        """
+        for filename in glob.glob(os.path.join(self._metricsdir, "worker*.json")):
+            os.remove(filename)
+
+    def add_gauge(self, name, text, value):
+        """Export the result of calling `value` as gauge `name` (evaluated
+           on `collect()`)
+        """
+        self._gauges[name] = (text, value)
+
+    def begin(self, method):
+        with self._lock:
+            self._inflight[method] = self._inflight.get(method, 0) + 1
+        self._maybe_flush()
+
+    def end(self, method, route, status, duration, reqsize, respsize):
+        """Record a finished request (`status` is the numeric code as a
+           string, `duration` in seconds)
+        """
+        key = (method, route, status)
+        nbuckets = len(self._buckets)
+        with self._lock:
+            self._inflight[method] -= 1
+            values = self._requests.get(key)
+            if values is None:
+                values = self._requests[key] = [0] * (nbuckets + 4)
+            for i, bound in enumerate(self._buckets):
+                if duration <= bound:
+                    values[i] += 1
+            values[nbuckets] += 1
+            values[nbuckets + 1] += duration
+            values[nbuckets + 2] += reqsize
+            values[nbuckets + 3] += respsize
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.time() - self._flushed >= self._interval:
+            self.flush()
+
+    def flush(self):
+        """Write this worker's snapshot
+        """
+        with self._lock:
+            snapshot = {"buckets" : self._buckets,
+                        "requests" : [list(key) + values for key, values in self._requests.items()],
+                        "inflight" : self._inflight}
+            self._flushed = time.time()
+            filename = os.path.join(self._metricsdir, "worker{}.json".format(util.worker_id()))
+            try:
+                fd, tmpname = tempfile.mkstemp(dir=self._metricsdir, prefix=".worker")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(snapshot, f)
+                os.rename(tmpname, filename)
+            except (IOError, OSError) as e:
+                LOG.warning("Could not write metrics snapshot: {}".format(e))
+
+    def collect(self):
+        """Metrics of all workers in Prometheus text format
+        """
+        self.flush()
+        nbuckets = len(self._buckets)
+        requests = {}
+        inflight = {}
+        for filename in sorted(glob.glob(os.path.join(self._metricsdir, "worker*.json"))):
+            try:
+                with open(filename) as f:
+                    snapshot = json.load(f)
+            except (IOError, ValueError) as e: #worker replacing its snapshot
+                LOG.warning("Could not read metrics snapshot {}: {}".format(filename, e))
+                continue
+            if snapshot["buckets"] != self._buckets:
+                continue #stale, from before a configuration change
+            for entry in snapshot["requests"]:
+                key, values = tuple(entry[:3]), entry[3:]
+                if key in requests:
+                    requests[key] = [a + b for a, b in zip(requests[key], values)]
+                else:
+                    requests[key] = values
+            for method, count in snapshot["inflight"].items():
+                inflight[method] = inflight.get(method, 0) + count
+
+        names = ["method", "route", "status"]
+        lines = ["# HELP stp_http_request_duration_seconds Time until the response body is returned (for streamed bodies of unknown length: until it is sent).",
+                 "# TYPE stp_http_request_duration_seconds histogram"]
+        for key in sorted(requests):
+            labels = _labels(names, key)
+            values = requests[key]
+            for bound, count in zip(self._buckets, values):
+                lines.append('stp_http_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, count))
+            lines.append('stp_http_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, values[nbuckets]))
+            lines.append("stp_http_request_duration_seconds_count{{{}}} {}".format(labels, values[nbuckets]))
+            lines.append("stp_http_request_duration_seconds_sum{{{}}} {}".format(labels, values[nbuckets + 1]))
+        for name, offset, text in [("stp_http_request_bytes_total", 2, "Request body bytes received."),
+                                   ("stp_http_response_bytes_total", 3, "Response body bytes sent.")]:
+            lines.extend(["# HELP {} {}".format(name, text), "# TYPE {} counter".format(name)])
+            for key in sorted(requests):
+                lines.append("{}{{{}}} {}".format(name, _labels(names, key), requests[key][nbuckets + offset]))
+        lines.extend(["# HELP stp_http_requests_in_flight Requests being processed (as of the workers' last snapshots).",
+                      "# TYPE stp_http_requests_in_flight gauge"])
+        for method in sorted(inflight):
+            lines.append("stp_http_requests_in_flight{{{}}} {}".format(_labels(["method"], [method]), inflight[method]))
+        for name, (text, value) in sorted(self._gauges.items()):
+            lines.extend(["# HELP {} {}".format(name, text), "# TYPE {} gauge".format(name), "{} {}".format(name, value())])
+        return "\n".join(lines) + "\n"
+
+
+_metrics = util.ProcessGlobal(Metrics)
+configure = _metrics.configure
+get = _metrics.get
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Incremental parser for multipart/form-data request bodies. The body
+   is read from `wsgi.input` in blocks of `bufsize` bytes: file parts
+   (parts with a `filename`) are streamed to spool files so that memory
+   use is bounded by the buffer size rather than the upload size, other
+   fields are returned as (byte) strings.
+"""
+from __future__ import unicode_literals, division, print_function #Py2
+
+import os
+import re
+import shutil
+import tempfile
+import logging
+
+import util
+from httperrs import BadRequestError
+
+LOG = logging.getLogger("APP.MULTIPART")
+
+MAX_HEADER_SIZE = 16 * 1024
+MAX_FIELD_SIZE = 1024 * 1024 #Non-file fields are kept in memory
+CRLF = b"\r\n"
+
+class UploadFile(object):
+    """File part spooled to disk. Consumers take ownership of the data
+       with `move()`, otherwise the spool file is removed on `close()`.
+    """
+    def __init__(self, name, filename, path, size):
+        self.name = name
+        self.filename = filename
+        self.path = path
+        self.size = size
+
+    def move(self, dest):
+        """Move the spool file to `dest` (a rename if on the same
+           filesystem)
+        """
+        shutil.move(self.path, dest)
+        self.path = None
+
+    def close(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+    def __repr__(self):
+        return "<UploadFile {} ({} bytes)>".format(self.filename, self.size)
+
+
+class _Reader(object):
+    """Buffered reader over the first `length` bytes of `stream`
+    """
+    def __init__(self, stream, length, bufsize):
+        self._stream = stream
+        self._remaining = length
+        self._bufsize = bufsize
+        self.buf = b""
+
+    def fill(self):
+        """Read another block into `buf`, returns False at end of input
+        """
+        if self._remaining <= 0:
+            return False
+        data = self._stream.read(min(self._bufsize, self._remaining))
+        if not data:
+            raise BadRequestError("Unexpected end of multipart body")
+        self._remaining -= len(data)
+        self.buf += data
+        return True
+
+    def until(self, sep, sink, maxsize=None):
+        """Pass data up to `sep` to `sink` (blockwise) and consume `sep`
+        """
+        size = 0
+        while True:
+            i = self.buf.find(sep)
+            if i != -1:
+                if maxsize is not None and size + i > maxsize:
+                    raise BadRequestError("Multipart field too large")
+                sink(self.buf[:i])
+                self.buf = self.buf[i + len(sep):]
+                return size + i
+            #Keep a tail that may hold the start of `sep`
+            keep = len(sep) - 1
+            if len(self.buf) > keep:
+                data, self.buf = self.buf[:len(self.buf) - keep], self.buf[len(self.buf) - keep:]
+                size += len(data)
+                if maxsize is not None and size > maxsize:
+                    raise BadRequestError("Multipart field too large")
+                sink(data)
+            if not self.fill():
+                raise BadRequestError("Malformed multipart body: missing boundary")
+
+    def read(self, n):
+        while len(self.buf) < n:
+            if not self.fill():
+                break
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+    def drain(self):
+        while self.fill():
+            self.buf = b""
+
+
+def _parse_disposition(value):
+    params = {}
+    for match in re.finditer(r';\s*([\w*-]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)', value):
+        key, val = match.group(1).lower(), match.group(2).strip()
+        if val.startswith('"'):
+            val = re.sub(r'\\(.)', r'\1', val[1:-1])
+        params[key] = val
+    return params
+
+def parse(env, spooldir, bufsize=64*1024):
+    """Parse the multipart/form-data body of WSGI request `env`. Returns
+       a dict mapping field names to strings or, for file parts, to
+       `UploadFile` instances (spooled in `spooldir`).
+    """
+    match = re.search(r'boundary=("?)([^";]+)\1', env.get("CONTENT_TYPE", ""))
+    if not match:
+        raise BadRequestError("Multipart request without boundary")
+    boundary = b"--" + match.group(2).encode("ascii")
+    util.makedirs(spooldir)
+    reader = _Reader(env["wsgi.input"], int(env.get("CONTENT_LENGTH") or 0), bufsize)
+    data = {}
+    try:
+        reader.until(boundary, lambda block: None) #preamble
+        while True:
+            if reader.read(2) != CRLF: #"--" (or junk) after final boundary
+                break
+            headers = []
+            reader.until(CRLF + CRLF, headers.append, MAX_HEADER_SIZE)
+            disposition = None
+            for line in b"".join(headers).split(CRLF):
+                key, sep, value = line.partition(b":")
+                if key.strip().lower() == b"content-disposition":
+                    disposition = _parse_disposition(value.decode("utf-8"))
+            if not disposition or "name" not in disposition:
+                raise BadRequestError("Multipart part without field name")
+            name = disposition["name"]
+            if "filename" in disposition:
+                fd, path = tempfile.mkstemp(dir=spooldir, prefix=".upload")
+                upload = UploadFile(name, disposition["filename"], path, 0)
+                data[name] = upload #ensure cleanup on failure
+                with os.fdopen(fd, "wb") as f:
+                    upload.size = reader.until(CRLF + boundary, f.write)
+                LOG.debug("Spooled {}: {}".format(name, upload))
+            else:
+                chunks = []
+                reader.until(CRLF + boundary, chunks.append, MAX_FIELD_SIZE)
+                data[name] = b"".join(chunks)
+        reader.drain() #epilogue
+    except:
+        close(data)
+        raise
+    return data
+
+def save(value, dest):
+    """Store request field `value` (an `UploadFile` or, e.g. for JSON
+       requests, a string) as file `dest`
+    """
+    if isinstance(value, UploadFile):
+        value.move(dest)
+    else:
+        with open(dest, "wb") as f:
+            f.write(value)
+
+def close(data):
+    """Remove spool files of `data` not taken over by a consumer
+    """
+    if not isinstance(data, dict): #JSON body
+        return
+    for value in data.values():
+        if isinstance(value, UploadFile):
+            value.close()
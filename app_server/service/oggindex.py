@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Page index for Ogg Vorbis files: maps granule positions (sample
+   numbers) to byte offsets so that a time range can be copied out of
+   a long recording by seeking directly to the relevant pages.
+
+   The extracted stream consists of the Vorbis header pages followed
+   by the audio pages spanning the range (with page sequence numbers
+   and checksums rewritten). Decoding it yields audio that ends
+   exactly at the granule position of the last copied page, so precise
+   boundaries are obtained by trimming relative to the end of the
+   decoded audio, see `Segment`.
+"""
+from __future__ import unicode_literals, division, print_function #Py2
+
+import os
+import math
+import struct
+import bisect
+import tempfile
+import logging
+
+LOG = logging.getLogger("APP.OGGINDEX")
+
+CAPTURE = b"OggS"
+PAGEHEADER = struct.Struct(str("<4sBBqIIIB")) #capture, version, flags, granule, serial, seqno, crc, segments
+FLAG_BOS = 0x02
+FLAG_EOS = 0x04
+INDEXMAGIC = b"OGGIDX1\n"
+INDEXHEADER = struct.Struct(str("<IIQQI")) #rate, channels, filesize, headerend, npages
+INDEXENTRY = struct.Struct(str("<qQ")) #granule, offset
+NUM_VORBIS_HEADERS = 3
+#Pages copied before the page containing the start sample, so that the
+#decoder has fully primed before the requested range
+PREROLL_PAGES = 2
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        r = i << 24
+        for j in range(8):
+            r = ((r << 1) ^ 0x04c11db7) if r & 0x80000000 else (r << 1)
+        table.append(r & 0xffffffff)
+    return table
+CRC_TABLE = _crc_table()
+
+def page_crc(page):
+    """Ogg checksum of `page` (with checksum field set to zero)
+    """
+    crc = 0
+    for byte in bytearray(page):
+        crc = ((crc << 8) & 0xffffffff) ^ CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+def index_path(filename):
+    return "{}.idx".format(filename)
+
+
+class OggIndex(object):
+    def __init__(self, rate, channels, filesize, headerend, pages):
+        self.rate = rate
+        self.channels = channels
+        self.filesize = filesize
+        self.headerend = headerend
+        #All audio pages as (granule, offset), granule is -1 for pages
+        #on which no packet completes
+        self.pages = pages
+        self._granules = [g for g, o in pages if g != -1]
+        self._granpages = [i for i, (g, o) in enumerate(pages) if g != -1]
+
+    @property
+    def duration(self):
+        if not self._granules:
+            return 0.0
+        return self._granules[-1] / self.rate
+
+    def metadata(self):
+        """Stream properties as read from the Ogg/Vorbis headers and page
+           granule positions (i.e. without decoding)
+        """
+        duration = self.duration
+        return {"container" : "ogg",
+                "codec" : "vorbis",
+                "samplerate" : self.rate,
+                "channels" : self.channels,
+                "duration" : duration,
+                "samples" : self._granules[-1] if self._granules else 0,
+                "size" : self.filesize,
+                "bitrate" : int(round(self.filesize * 8 / duration)) if duration else None}
+
+    @classmethod
+    def build(cls, filename):
+        """Scan `filename` once, reading only page headers (and the Vorbis
+           identification header)
+        """
+        rate = channels = serial = None
+        headerend = None
+        npackets = 0
+        pages = []
+        filesize = os.path.getsize(filename)
+        with open(filename, "rb") as f:
+            offset = 0
+            while offset < filesize:
+                header = f.read(PAGEHEADER.size)
+                if len(header) < PAGEHEADER.size:
+                    break #truncated final page
+                capture, version, flags, granule, pserial, seqno, crc, nsegs = PAGEHEADER.unpack(header)
+                if capture != CAPTURE:
+                    raise ValueError("Not an Ogg file or corrupt page at offset {}".format(offset))
+                if serial is None:
+                    serial = pserial
+                elif pserial != serial:
+                    raise ValueError("Chained or multiplexed Ogg streams not supported")
+                lacing = bytearray(f.read(nsegs))
+                bodysize = sum(lacing)
+                if headerend is None:
+                    if rate is None:
+                        body = f.read(bodysize)
+                        if body[:7] != b"\x01vorbis" or len(body) < 16:
+                            raise ValueError("Not an Ogg Vorbis stream")
+                        channels = bytearray(body[11:12])[0]
+                        rate = struct.unpack(str("<I"), body[12:16])[0]
+                    else:
+                        f.seek(bodysize, os.SEEK_CUR)
+                    npackets += sum(1 for v in lacing if v < 255)
+                    if npackets >= NUM_VORBIS_HEADERS:
+                        headerend = offset + PAGEHEADER.size + nsegs + bodysize
+                else:
+                    pages.append((granule, offset))
+                    f.seek(bodysize, os.SEEK_CUR)
+                offset += PAGEHEADER.size + nsegs + bodysize
+        if headerend is None:
+            raise ValueError("Incomplete Vorbis headers")
+        LOG.debug("Indexed {}: {} pages".format(filename, len(pages)))
+        return cls(rate, channels, filesize, headerend, pages)
+
+    def save(self, filename):
+        """Write index atomically to `filename`
+        """
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(INDEXMAGIC)
+                f.write(INDEXHEADER.pack(self.rate, self.channels, self.filesize, self.headerend, len(self.pages)))
+                for granule, offset in self.pages:
+                    f.write(INDEXENTRY.pack(granule, offset))
+            os.rename(tmpname, filename)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as f:
+            if f.read(len(INDEXMAGIC)) != INDEXMAGIC:
+                raise ValueError("Not an Ogg index file")
+            rate, channels, filesize, headerend, npages = INDEXHEADER.unpack(f.read(INDEXHEADER.size))
+            data = f.read(npages * INDEXENTRY.size)
+        pages = [INDEXENTRY.unpack_from(data, i * INDEXENTRY.size) for i in range(npages)]
+        return cls(rate, channels, filesize, headerend, pages)
+
+    @classmethod
+    def for_file(cls, filename):
+        """Load the index persisted next to `filename`, (re)building it if
+           missing or stale
+        """
+        idxfile = index_path(filename)
+        try:
+            index = cls.load(idxfile)
+            if index.filesize == os.path.getsize(filename):
+                return index
+        except (IOError, OSError, ValueError, struct.error):
+            pass
+        index = cls.build(filename)
+        index.save(idxfile)
+        return index
+
+    def extract(self, filename, start, end, outfh):
+        """Write an Ogg Vorbis stream covering `start` to `end` (seconds)
+           to `outfh`. Returns a `Segment` describing where the requested
+           range lies in the decoded output of that stream.
+        """
+        if not self._granules:
+            raise ValueError("No audio pages in file")
+        first = int(math.floor(float(start) * self.rate))
+        last = int(math.ceil(float(end) * self.rate))
+        if last <= first:
+            raise ValueError("Empty audio range")
+        #First page: PREROLL_PAGES before the last page ending at or before `first`
+        i = bisect.bisect_right(self._granules, first) - 1
+        i = max(i - PREROLL_PAGES, -1)
+        startpage = self._granpages[i] + 1 if i >= 0 else 0
+        #Last page: first page ending at or after `last` (else end of file)
+        j = bisect.bisect_left(self._granules, last)
+        j = min(j, len(self._granules) - 1)
+        endpage = self._granpages[j]
+        endgranule = self._granules[j]
+        startoffset = self.pages[startpage][1]
+        endoffset = self.pages[endpage + 1][1] if endpage + 1 < len(self.pages) else self.filesize
+
+        with open(filename, "rb") as f:
+            header = f.read(self.headerend)
+            seqno = 0
+            pos = 0
+            while pos < len(header): #count header pages
+                nsegs = bytearray(header[pos + PAGEHEADER.size - 1:pos + PAGEHEADER.size])[0]
+                pos += PAGEHEADER.size + nsegs + sum(bytearray(header[pos + PAGEHEADER.size:pos + PAGEHEADER.size + nsegs]))
+                seqno += 1
+            outfh.write(header)
+            f.seek(startoffset)
+            chunk = f.read(endoffset - startoffset)
+        pos = 0
+        while pos < len(chunk):
+            capture, version, flags, granule, serial, pseqno, crc, nsegs = PAGEHEADER.unpack_from(chunk, pos)
+            pagesize = PAGEHEADER.size + nsegs + sum(bytearray(chunk[pos + PAGEHEADER.size:pos + PAGEHEADER.size + nsegs]))
+            if pos + pagesize >= len(chunk):
+                flags |= FLAG_EOS
+            flags &= ~FLAG_BOS
+            page = bytearray(chunk[pos:pos + pagesize])
+            page[:PAGEHEADER.size] = PAGEHEADER.pack(capture, version, flags, granule, serial, seqno, 0, nsegs)
+            crc = page_crc(page)
+            page[22:26] = struct.pack(str("<I"), crc)
+            outfh.write(page)
+            seqno += 1
+            pos += pagesize
+        return Segment(self.rate, endgranule, first, min(last, endgranule))
+
+
+class Segment(object):
+    """Position of the requested samples [`first`, `last`) relative to
+       the end of the decoded extracted stream (which ends at sample
+       `endgranule`)
+    """
+    def __init__(self, rate, endgranule, first, last):
+        self.rate = rate
+        self.fromend = endgranule - first
+        self.length = max(last - first, 0)
+
+    def sox_trim(self):
+        """Arguments for the SoX `trim` effect selecting the segment
+        """
+        return ["trim", "-{}s".format(self.fromend), "{}s".format(self.length)]
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Opt-in request profiling: every `every`th request (among those with
+   a path matching one of the shell-style patterns in `routes`, if
+   given) is profiled and the profile written to `profiledir`, keeping
+   the newest `keep` profiles.
+
+   Modes:
+     - "cprofile": deterministic profile with cProfile, written as
+       `.pstats` (e.g. `python -m pstats`, snakeviz, flameprof)
+     - "sample": the request thread's stack is sampled every `interval`
+       seconds by a helper thread (low overhead), written in the folded
+       format of flamegraph.pl as `.folded`
+
+   Settings changed with `update()` (see the admin service) are written
+   to a file in `profiledir` and picked up by all workers.
+"""
+from __future__ import unicode_literals, division, print_function #Py2
+
+import os
+import re
+import sys
+import json
+import glob
+import time
+import marshal
+import errno
+import fnmatch
+import cProfile
+import tempfile
+import logging
+import threading
+
+import util
+
+LOG = logging.getLogger("APP.PROFILER")
+
+MODES = ["cprofile", "sample"]
+SETTINGS = "settings.json"
+REFRESH_INTERVAL = 1.0 #seconds between checks for changed settings
+
+def _flag(value):
+    """Boolean setting from JSON or a form field ("true"/"false", ...)
+    """
+    if isinstance(value, basestring):
+        value = value.strip().lower()
+        if value in ("true", "yes", "on", "1"):
+            return True
+        if value in ("false", "no", "off", "0"):
+            return False
+    elif value in (True, False): #also 0 and 1
+        return bool(value)
+    raise ValueError("enabled must be true or false")
+
+class _Sampler(threading.Thread):
+    """Samples the stack of thread `ident` every `interval` seconds,
+       counting folded stacks
+    """
+    def __init__(self, ident, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._ident = ident
+        self._interval = interval
+        self._done = threading.Event()
+        self.stacks = {}
+
+    def run(self):
+        while not self._done.wait(self._interval):
+            frame = sys._current_frames().get(self._ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+class Profiler(object):
+    def __init__(self, profiledir=None, enabled=False, every=100, routes=None, mode="cprofile", interval=0.005, keep=100):
+        self._profiledir = profiledir or os.path.join(tempfile.gettempdir(), "stp-profiles")
+        self._defaults = self._check({"enabled" : enabled, "every" : every, "routes" : routes or [], "mode" : mode})
+        self._settings = dict(self._defaults)
+        self._interval = float(interval)
+        self._keep = int(keep)
+        self._lock = threading.Lock()
+        self._count = 0
+        self._checked = 0.0
+        self._mtime = None
+        util.makedirs(self._profiledir)
+
+    def _check(self, settings):
+        settings["enabled"] = _flag(settings["enabled"])
+        settings["every"] = int(settings["every"])
+        if settings["every"] < 1:
+            raise ValueError("every must be at least 1")
+        if type(settings["routes"]) is not list:
+            raise ValueError("routes must be a list of path patterns")
+        if settings["mode"] not in MODES:
+            raise ValueError("Unknown profiler mode: {}".format(settings["mode"]))
+        return settings
+
+    def reset(self):
+        """Discard settings changed with `update()`, e.g. at server start
+        """
+        try:
+            os.remove(os.path.join(self._profiledir, SETTINGS))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._checked = 0.0
+
+    def _refresh(self):
+        now = time.time()
+        if now - self._checked < REFRESH_INTERVAL:
+            return
+        self._checked = now
+        filename = os.path.join(self._profiledir, SETTINGS)
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        settings = dict(self._defaults)
+        if mtime is not None:
+            try:
+                with open(filename) as f:
+                    settings.update(json.load(f))
+            except (IOError, ValueError) as e:
+                LOG.warning("Could not read profiler settings: {}".format(e))
+                return
+        self._settings = settings
+        self._mtime = mtime
+        LOG.info("Profiler settings: {}".format(settings))
+
+    def settings(self):
+        self._refresh()
+        return dict(self._settings)
+
+    def update(self, **settings):
+        """Change settings on all workers, returns the new settings.
+           Raises ValueError for invalid settings.
+        """
+        self._refresh()
+        new = dict(self._settings)
+        new.update(settings)
+        new = self._check(new)
+        fd, tmpname = tempfile.mkstemp(dir=self._profiledir, prefix=".settings")
+        with os.fdopen(fd, "w") as f:
+            json.dump(new, f)
+        os.rename(tmpname, os.path.join(self._profiledir, SETTINGS))
+        self._checked = 0.0
+        return self.settings()
+
+    def wanted(self, path):
+        """Whether to profile a request for `path`
+        """
+        self._refresh()
+        settings = self._settings
+        if not settings["enabled"]:
+            return False
+        if settings["routes"] and not any(fnmatch.fnmatchcase(path, pattern) for pattern in settings["routes"]):
+            return False
+        with self._lock:
+            self._count += 1
+            return self._count % settings["every"] == 0
+
+    def run(self, label, fn, *args):
+        """Call `fn(*args)` under the profiler, saving the profile under
+           a name including `label`
+        """
+        mode = self._settings["mode"]
+        started = time.time()
+        if mode == "sample":
+            sampler = _Sampler(threading.current_thread().ident, self._interval)
+            sampler.start()
+            try:
+                return fn(*args)
+            finally:
+                sampler.stop()
+                self._save(label, started, "folded",
+                           lambda f: f.write("".join("{} {}\n".format(stack, count) for stack, count in sampler.stacks.items()).encode("utf-8")))
+        else:
+            prof = cProfile.Profile()
+            try:
+                return prof.runcall(fn, *args)
+            finally:
+                prof.create_stats()
+                self._save(label, started, "pstats", lambda f: marshal.dump(prof.stats, f)) #as Profile.dump_stats()
+
+    def _save(self, label, started, ext, write):
+        """Write a profile with `write(file)` and remove the oldest
+           profiles beyond `keep`
+        """
+        name = "{}-{:03d}-w{}-{}ms-{}.{}".format(time.strftime("%Y%m%d%H%M%S", time.localtime(started)),
+                                                 int(started * 1000) % 1000,
+                                                 util.worker_id(),
+                                                 int((time.time() - started) * 1000),
+                                                 re.sub(r"[^\w.-]+", "_", label).strip("_")[:80],
+                                                 ext)
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=self._profiledir, prefix=".profile")
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.rename(tmpname, os.path.join(self._profiledir, name))
+            LOG.info("Saved profile: {}".format(name))
+            profiles = sorted(glob.glob(os.path.join(self._profiledir, "*.pstats")) +
+                              glob.glob(os.path.join(self._profiledir, "*.folded")),
+                              key=os.path.basename)
+            for filename in profiles[:max(0, len(profiles) - self._keep)]:
+                try:
+                    os.remove(filename)
+                except OSError as e: #removed by another worker
+                    if e.errno != errno.ENOENT:
+                        raise
+        except (IOError, OSError) as e:
+            LOG.warning("Could not save profile: {}".format(e))
+
+
+_profiler = util.ProcessGlobal(Profiler)
+configure = _profiler.configure
+get = _profiler.get
@@ -10,7 +10,7 @@ import datetime
 import base64
 import os
 import shutil
-import subprocess
+import tempfile
 import logging
 from functools import wraps
 from types import FunctionType
@@ -26,16 +26,28 @@ import requests #Ubuntu/Debian: apt-get install python-requests
 import auth
 import admin
 import repo
+import audio
+import audiostore
+import oggindex
+import background
+import multipart
+import applog
 from httperrs import *
 
 LOG = logging.getLogger("APP.PROJECTS")
 
 SPEECHSERVER = os.getenv("SPEECHSERVER"); assert SPEECHSERVER is not None
 APPSERVER = os.getenv("APPSERVER"); assert APPSERVER is not None
-SOXI_BIN = "/usr/bin/soxi"; assert os.stat(SOXI_BIN)
 
 TASKID_DIR_ZFILL = 3
 
+#Content-addressed audio shared between projects, under storage
+AUDIOSTORE_DIR = "audiostore"
+#Resumable uploads: chunks are kept in this directory under storage
+UPLOADS_DIR = "uploads"
+MAX_CHUNKSIZE = 64 * 1024 * 1024
+UPLOAD_LIFE = 7 * 24 * 3600 #Unfinished uploads are removed after this time (seconds)
+
 ## TODO: project manager and collator are the same and share UI
 ## FLOW: PM uploads and assigns task. The assignment re-assigns the project the collator
 ## The PM can still view created projects
@@ -51,11 +63,8 @@ def authlog(okaymsg):
         @wraps(f)
         def wrapper(*args, **kw):
             self, request = args[:2]
-            if not "file" in request:
-                LOG.debug("ENTER: request={}".format(request), extra=logfuncname)
-            else:
-                LOG.debug("ENTER: without 'file' --> request={}".format(
-                    dict([(k, request[k]) for k in request if k != "file"])), extra=logfuncname)
+            if LOG.isEnabledFor(logging.DEBUG):
+                LOG.debug("ENTER: request={}".format(applog.redact(request)), extra=logfuncname)
             username = None #in case exception before authenticate
             try:
                 #AUTH + INSERT USERNAME INTO FUNC SCOPE
@@ -181,13 +190,26 @@ class Projects(auth.UserAuth):
         """
         #Clear project from DB
         with self.db as db:
-            row = db.get_project(request["projectid"], ["audiofile"])
+            db.lock()
+            row = db.get_project(request["projectid"], ["audiofile", "audiohash", "jobid", "creation"])
+            #The ingest job would write to the removed project directory
+            if row.get("jobid") and row["jobid"].startswith("upload_audio:"):
+                raise ConflictError("Project audio is being processed, delete when done")
+            uploads = db.get_project_uploads(request["projectid"])
             db.delete_project(request["projectid"])
         #Remove any files associated with project
         if row:
+            store = audiostore.AudioStore(self._audiostore_dir())
             if row["audiofile"]:
                 projectpath = os.path.dirname(row["audiofile"])
-                shutil.rmtree(projectpath, ignore_errors=True)
+            else:
+                projectpath = self._project_dir(username, row["creation"], request["projectid"])
+            release_spurious_audio(store, projectpath, row["audiofile"])
+            shutil.rmtree(projectpath, ignore_errors=True)
+            #Drop the project's reference to shared audio
+            store.release(row["audiohash"])
+        for uploadid in uploads:
+            shutil.rmtree(self._upload_dir(uploadid), ignore_errors=True)
         return "Project deleted!"
 
     @authlog("Returning loaded project")
@@ -198,9 +220,10 @@ class Projects(auth.UserAuth):
             #This will lock the DB:
             db.check_project(request["projectid"], check_err=False) #DEMIT: check_err?
             project = db.get_project(request["projectid"],
-                                     fields=["projectname", "category", "year", "collator", "creator"])
+                                     fields=["projectname", "category", "year", "collator", "creator", "audiodur", "audiometa"])
             tasks = db.get_tasks(request["projectid"],
                                  fields=["taskid", "editor", "start", "end", "language", "speaker", "editing"])
+        project["audiometa"] = json.loads(project["audiometa"]) if project["audiometa"] else None
         return {'project' : project, 'tasks' : tasks}
 
     @authlog("Save project fields and tasks if in request")
@@ -286,7 +309,7 @@ class Projects(auth.UserAuth):
         try:
             #Create files and update fields
             textname = "text"
-            updatefields = ("textfile", "creation", "modified", "commitid")
+            updatefields = ("textfile", "creation", "modified", "commitid", "audiostatus")
             audiodir = os.path.dirname(row["audiofile"])
             textdirs = []
             for task in tasks:
@@ -298,12 +321,15 @@ class Projects(auth.UserAuth):
                 open(task["textfile"], "wb").close()
                 task["commitid"], task["creation"] = repo.commit(textdir, textname, "task assigned")
                 task["modified"] = task["creation"]
+                task["audiostatus"] = "pending"
 
             #Update fields and unlock project
             with self.db as db:
                 db.update_tasks(request["projectid"], tasks, fields=updatefields)
                 db.update_project(request["projectid"], data={"collator" : request["collator"], "assigned": "Y"})
                 db.unlock_project(request["projectid"])
+            #Task boundaries are now fixed: render task audio ahead of editor requests
+            background.submit(render_task_audio, self._config["projectdb"], request["projectid"], row["audiofile"], tasks)
             return 'Project tasks assigned!'
         except:
             LOG.debug("(projectid={}) FAIL: Cleaning up filesystem and unlocking".format(request["projectid"]))
@@ -360,7 +386,7 @@ class Projects(auth.UserAuth):
             db.lock()
             #Project exists and locked?
             row = db.get_project(request["projectid"], ["jobid"])
-            if row is None:
+            if not row:
                 raise ConflictError("Project does not exist")
             jobid = row["jobid"]
             if not jobid:
@@ -375,10 +401,10 @@ class Projects(auth.UserAuth):
                     shutil.rmtree(textdir, ignore_errors=True)
                 db.unlock_project(request["projectid"], errstatus="assign_tasks")
                 return "Project unlocked: Task assignment failed"
-            elif jobid == "upload_audio": #DEMIT: Revisit audiofile name generation?
-                LOG.info("(projectid={}) Previous failure in upload_audio(): Nothing to be done (filesystem may contain spurious audio file)".format(request["projectid"]))
+            elif jobid.startswith("upload_audio"):
+                LOG.info("(projectid={}) Previous failure or unfinished ingest in upload_audio(): Removing spurious audio files".format(request["projectid"]))
+                row = db.get_project(request["projectid"], ["audiofile", "creation"])
                 db.unlock_project(request["projectid"], errstatus="upload_audio")
-                return "Project unlocked: Audio upload failed"
             elif jobid == "diarize_audio":
                 LOG.info("(projectid={}) Previous failure in diarize_audio(): Cleaning up DB".format(request["projectid"]))
                 db.delete_incoming(request["projectid"])
@@ -390,6 +416,15 @@ class Projects(auth.UserAuth):
                 db.delete_incoming(request["projectid"])
                 db.delete_outgoing(request["projectid"])
                 db.unlock_project(request["projectid"], errstatus="diarize_audio")
+        if jobid.startswith("upload_audio"):
+            #Audio stored by an ingest job that did not finish (e.g. the
+            #worker died) still holds a reference to its blob
+            if row["audiofile"]:
+                projectpath = os.path.dirname(row["audiofile"])
+            else:
+                projectpath = self._project_dir(username, row["creation"], request["projectid"])
+            release_spurious_audio(audiostore.AudioStore(self._audiostore_dir()), projectpath, row["audiofile"])
+            return "Project unlocked: Audio upload failed"
         #Send cancel job request to SpeechServ:
         # TEMPORARILY COMMENTED OUT FOR TESTING WITHOUT SPEECHSERVER:
         # cancelreq = {}
@@ -400,77 +435,218 @@ class Projects(auth.UserAuth):
 
     @authlog("Audio uploaded")
     def upload_audio(self, request):
-        """Audio uploaded to project space
+        """Audio uploaded to project space. Returns once the file is
+           stored: validation and gain normalised renditions (so that full
+           audio requests can be served without transcoding) are done by
+           a background job, poll `jobid`/`errstatus` of the project.
            TODO: convert audio to OGG Vorbis, mp3splt for editor
         """
+        return self._store_audio(username, request["projectid"], request["file"])
+
+    def _store_audio(self, username, projectid, upload):
+        """Store `upload` (see `multipart.save`) as the project's audio and
+           hand validation and creation of renditions, index and peaks
+           to a background ingest job (see `ingest_audio`). The project
+           stays locked with an "upload_audio:..." `jobid` until the job
+           completes; failures are reported in `errstatus`.
+        """
         audiofile = None
+        jobid = "upload_audio:{}".format(uuid.uuid4())
         with self.db as db:
             #This will lock the DB:
-            db.check_project(request["projectid"], check_err=False) #DEMIT: check_err?
+            db.check_project(projectid, check_err=False) #DEMIT: check_err?
             #Check whether tasks already assigned
-            if db.project_assigned(request["projectid"]):
+            if db.project_assigned(projectid):
                 raise ConflictError("Cannot re-upload audio because tasks are already assigned")
             #Get current project details
-            row = db.get_project(request["projectid"], ["audiofile", "creation"])
+            row = db.get_project(projectid, ["audiofile", "normaudiofile", "audiohash", "creation"])
             #Lock project
-            db.lock_project(request["projectid"], jobid="upload_audio")
+            db.lock_project(projectid, jobid=jobid)
         try:
             #Create project path if needed
-            pcreation = datetime.datetime.fromtimestamp(row["creation"])
-            ppath = os.path.join(self._config["storage"],
-                                 username,
-                                 str(pcreation.year),
-                                 str(pcreation.month).zfill(2),
-                                 str(pcreation.day).zfill(2),
-                                 request["projectid"])
+            ppath = self._project_dir(username, row["creation"], projectid)
             if not os.path.exists(ppath):
                 os.makedirs(ppath)
 
             #Write audio file (DEMIT: check audiofile name creation)
             audiofile = os.path.join(ppath, base64.urlsafe_b64encode(str(uuid.uuid4())))
-            with open(audiofile, 'wb') as f:
-                f.write(request['file'])
-            audiodur = float(subprocess.check_output([SOXI_BIN, "-D", audiofile]))
-            #Check channel number
-            channels = int(subprocess.check_output([SOXI_BIN, "-c", audiofile]))
-            if channels != 1:
-                raise BadRequestError("Only single channel audio supported! Split channels into separate files.")
-            #Check encoding and file type
-            audtype = str(subprocess.check_output([SOXI_BIN, "-t", audiofile])).upper()
-            encoding = str(subprocess.check_output([SOXI_BIN, "-e", audiofile])).upper()
-            if "VORBIS" not in audtype and "VORBIS" not in encoding:
-                raise BadRequestError("Only OGG Vorbis audio supported! Re-encode audio file.")
-
-            #Update fields and unlock project            
-            with self.db as db:
-                db.update_project(request["projectid"], {"audiofile": audiofile, "audiodur": audiodur})
-                db.delete_tasks(request["projectid"])
-                db.unlock_project(request["projectid"])
-            #Remove previous audiofile if it exists
-            if row["audiofile"]:
-                os.remove(row["audiofile"])
-            return 'Audio Saved!'
+            multipart.save(upload, audiofile)
+            with open(audiofile, "rb") as f: #durable before acknowledging
+                os.fsync(f.fileno())
+            background.submit(ingest_audio, self._config["projectdb"], self._audiostore_dir(), projectid, jobid, audiofile,
+                              [row["audiofile"], row["normaudiofile"]], row["audiohash"])
+            return {"message" : "Audio received: processing", "jobid" : jobid}
         except Exception as e:
-            LOG.debug("(projectid={}) FAIL: Unlocking".format(request["projectid"]))
+            LOG.debug("(projectid={}) FAIL: Unlocking".format(projectid))
             LOG.error(str(e))
             #Unlock the project and set errstatus
             with self.db as db:
-                db.unlock_project(request["projectid"], errstatus="upload audio error")
+                db.unlock_project(projectid, errstatus="upload audio error")
             if audiofile is not None:
-                os.remove(audiofile)
+                audio.remove_audio(audiofile)
             raise RuntimeError(str(e))
 
+    def _project_dir(self, username, creation, projectid):
+        pcreation = datetime.datetime.fromtimestamp(creation)
+        return os.path.join(self._config["storage"],
+                            username,
+                            str(pcreation.year),
+                            str(pcreation.month).zfill(2),
+                            str(pcreation.day).zfill(2),
+                            projectid)
+
+    def _audiostore_dir(self):
+        return self._config.get("audiostore", os.path.join(self._config["storage"], AUDIOSTORE_DIR))
+
+    def _upload_dir(self, uploadid):
+        return os.path.join(self._config["storage"], UPLOADS_DIR, uploadid)
+
+    def _get_upload(self, db, username, uploadid):
+        row = db.get_upload(uploadid)
+        if not row or row["username"] != username:
+            raise NotFoundError("Upload not found")
+        return row
+
+    @authlog("Chunked upload opened")
+    def open_upload(self, request):
+        """Start a resumable upload of project audio: the file of `size`
+           bytes is sent in chunks of `chunksize` bytes (the last may be
+           shorter) with `upload_chunk`, then stored with `finalize_upload`
+        """
+        try:
+            size = int(request["size"])
+            chunksize = int(request["chunksize"])
+        except ValueError:
+            raise BadRequestError("Parameters size and chunksize must be integers")
+        maxchunksize = self._config.get("maxchunksize", MAX_CHUNKSIZE)
+        if size <= 0 or not 0 < chunksize <= maxchunksize:
+            raise BadRequestError("Invalid size or chunksize (maximum chunksize is {})".format(maxchunksize))
+        #Remove abandoned uploads
+        with self.db as db:
+            stale = db.get_stale_uploads(time.time() - self._config.get("uploadlife", UPLOAD_LIFE))
+            for uploadid in stale:
+                db.delete_upload(uploadid)
+        for uploadid in stale:
+            shutil.rmtree(self._upload_dir(uploadid), ignore_errors=True)
+
+        with self.db as db:
+            db.check_project(request["projectid"], check_err=False)
+            if db.project_assigned(request["projectid"]):
+                raise ConflictError("Cannot re-upload audio because tasks are already assigned")
+            uploadid = str(uuid.uuid4())
+            db.insert_upload(uploadid, request["projectid"], username, request["filename"], size, chunksize)
+        os.makedirs(self._upload_dir(uploadid))
+        return {"uploadid" : uploadid, "nchunks" : nchunks(size, chunksize)}
+
+    @authlog("Chunk received")
+    def upload_chunk(self, request):
+        """Receive chunk number `chunkno` (from 0) of an upload, `checksum`
+           is the SHA-256 hex digest of the chunk. Chunks may be sent in
+           any order and re-sent.
+        """
+        with self.db as db:
+            row = self._get_upload(db, username, request["uploadid"])
+        if row.get("state") == "finalizing":
+            raise ConflictError("Upload is being finalized")
+        try:
+            chunkno = int(request["chunkno"])
+        except ValueError:
+            raise BadRequestError("Parameter chunkno must be an integer")
+        total = nchunks(row["size"], row["chunksize"])
+        if not 0 <= chunkno < total:
+            raise BadRequestError("Chunk number out of range (0 to {})".format(total - 1))
+        expected = row["chunksize"] if chunkno < total - 1 else row["size"] - (total - 1) * row["chunksize"]
+        updir = self._upload_dir(request["uploadid"])
+        chunkfile = os.path.join(updir, "{}.chunk".format(chunkno))
+        fd, tmpfile = tempfile.mkstemp(dir=updir, prefix=".chunk") #unique: the chunk may be re-sent concurrently
+        os.close(fd)
+        try:
+            multipart.save(request["file"], tmpfile)
+            size, checksum = audiostore.sha256_file(tmpfile)
+            if size != expected:
+                raise BadRequestError("Chunk {} has {} bytes, expected {}".format(chunkno, size, expected))
+            if checksum != request["checksum"].lower():
+                raise BadRequestError("Checksum mismatch for chunk {}".format(chunkno))
+            with self.db as db:
+                db.lock() #not while finalize_upload is assembling
+                row = self._get_upload(db, username, request["uploadid"])
+                if row.get("state") == "finalizing":
+                    raise ConflictError("Upload is being finalized")
+                os.rename(tmpfile, chunkfile)
+        finally:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+        return {"chunkno" : chunkno}
+
+    @authlog("Returning upload status")
+    def upload_status(self, request):
+        """List chunks received so far
+        """
+        with self.db as db:
+            row = self._get_upload(db, username, request["uploadid"])
+        return {"projectid" : row["projectid"],
+                "size" : row["size"],
+                "chunksize" : row["chunksize"],
+                "nchunks" : nchunks(row["size"], row["chunksize"]),
+                "received" : received_chunks(self._upload_dir(request["uploadid"]))}
+
+    @authlog("Chunked upload finalized")
+    def finalize_upload(self, request):
+        """Assemble the chunks and store the result as project audio (as
+           in `upload_audio`)
+        """
+        updir = self._upload_dir(request["uploadid"])
+        with self.db as db:
+            #Claim the upload: concurrent finalize and chunk requests are refused
+            db.lock()
+            row = self._get_upload(db, username, request["uploadid"])
+            if row.get("state") == "finalizing":
+                raise ConflictError("Upload is already being finalized")
+            total = nchunks(row["size"], row["chunksize"])
+            missing = sorted(set(range(total)) - set(received_chunks(updir)))
+            if missing:
+                raise ConflictError("Upload incomplete, missing chunks: {}".format(", ".join(map(str, missing))))
+            db.set_upload_state(request["uploadid"], "finalizing")
+        fd, assembled = tempfile.mkstemp(dir=updir, prefix=".assembled")
+        try:
+            with os.fdopen(fd, "wb") as outfh:
+                for chunkno in range(total):
+                    with open(os.path.join(updir, "{}.chunk".format(chunkno)), "rb") as infh:
+                        shutil.copyfileobj(infh, outfh, 1024 * 1024)
+            upload = multipart.UploadFile("file", row["filename"], assembled, row["size"])
+            result = self._store_audio(username, row["projectid"], upload)
+        except:
+            with self.db as db: #can be retried
+                db.set_upload_state(request["uploadid"], "open")
+            raise
+        finally:
+            if os.path.exists(assembled):
+                os.remove(assembled)
+        with self.db as db:
+            db.delete_upload(request["uploadid"])
+        shutil.rmtree(updir, ignore_errors=True)
+        return result
+
     @authlog("Returning audio for project")
     def get_audio(self, request):
-        """Make audio available for project user
+        """Make audio available for project user, optionally in a lower
+           `quality` rendition
         """
+        quality = request.get("quality", audio.DEFAULT_QUALITY)
+        if quality not in audio.QUALITIES:
+            raise BadRequestError("Unknown audio quality: {}".format(quality))
         with self.db as db:
-            row = db.get_project(request["projectid"], fields=["audiofile"])
+            row = db.get_project(request["projectid"], fields=["audiofile", "normaudiofile"])
             if not row:
                 raise NotFoundError("Project not found")
             if not row["audiofile"]:
                 raise ConflictError("No audio has been uploaded")
-        return {"mime": "audio/ogg", "filename" : row["audiofile"]}
+        if quality == audio.DEFAULT_QUALITY and row["normaudiofile"]:
+            return {"mime": "audio/ogg", "filename" : row["normaudiofile"], "normalized": True}
+        rendition = audio.rendition_path(row["audiofile"], quality)
+        if os.path.exists(rendition):
+            return {"mime": "audio/ogg", "filename" : rendition, "normalized": True}
+        return {"mime": "audio/ogg", "filename" : row["audiofile"], "quality" : quality}
 
     @authlog("Diarize audio request sent")
     def diarize_audio(self, request):
@@ -481,14 +657,14 @@ class Projects(auth.UserAuth):
             if db.project_assigned(request["projectid"]):
                 raise ConflictError("Tasks have already been assigned")
             #Get audiofile path and exists?
-            row = db.get_project(request["projectid"], ["audiofile"])
+            row = db.get_project(request["projectid"], ["audiofile", "normaudiofile"])
             if not row["audiofile"]:
                 raise ConflictError("No audio has been uploaded")
             #Set up I/O access and lock the project
             inurl = auth.gen_token()
             outurl = auth.gen_token()
             db.insert_incoming(request["projectid"], url=inurl, servicetype="diarize")
-            db.insert_outgoing(request["projectid"], url=outurl, audiofile=row["audiofile"])
+            db.insert_outgoing(request["projectid"], url=outurl, audiofile=row["normaudiofile"] or row["audiofile"])
             db.lock_project(request["projectid"], jobid="diarize_audio")
         #Make job request:
         try:
@@ -539,21 +715,24 @@ class Projects(auth.UserAuth):
             with self.db as db:
                 row = db.get_outgoing(uri)
                 if not row:
-                    raise MethodNotAllowedError(uri)
+                    raise NotFoundError(uri)
+                normaudiofile = db.get_project(row["projectid"], ["normaudiofile"]).get("normaudiofile")
             LOG.info("OK: (url={} projectid={}) Returning audio".format(uri, row["projectid"]))
+            if normaudiofile and normaudiofile == row["audiofile"]:
+                return {"mime": "audio/ogg", "filename": row["audiofile"], "normalized": True}
             return {"mime": "audio/ogg", "filename": row["audiofile"]}
         except Exception as e:
             LOG.info("FAIL: {}".format(e))
             raise
 
     def incoming(self, uri, data):
-        LOG.debug("ENTER: url={} data={}".format(uri, data))
+        LOG.debug("ENTER: url={} data={}".format(uri, applog.redact(data)))
         try:
             LOG.info("ENTER: url={}".format(uri))
             with self.db as db:
                 row = db.get_incoming(uri)
             if not row: #url exists?
-                raise MethodNotAllowedError(uri)
+                raise NotFoundError(uri)
             #Switch to handler for "servicetype"
             if not row["servicetype"] in self._config["speechservices"]:
                 raise Exception("Service type '{}' not defined in AppServer".format(row["servicetype"]))
@@ -566,7 +745,7 @@ class Projects(auth.UserAuth):
             raise
 
     def _incoming_diarize(self, data, projectid):
-        LOG.debug("ENTER: projectid={} data={}".format(projectid, data))
+        LOG.debug("ENTER: projectid={} data={}".format(projectid, applog.redact(data)))
         try:
             #Check whether SpeechServ job was successful
             if not "CTM" in data:
@@ -726,8 +905,31 @@ class ProjectDB(sqlite.Connection):
 
     def delete_project(self, projectid):
         self.delete_tasks(projectid)
+        self.execute("DELETE FROM uploads WHERE projectid=?", (projectid,))
         self.execute("DELETE FROM projects WHERE projectid=?", (projectid,))
 
+    def insert_upload(self, uploadid, projectid, username, filename, size, chunksize):
+        self.execute("INSERT INTO uploads (uploadid, projectid, username, filename, size, chunksize, created, state) VALUES (?,?,?,?,?,?,?,?)",
+                     (uploadid, projectid, username, filename, size, chunksize, time.time(), "open"))
+
+    def set_upload_state(self, uploadid, state):
+        self.execute("UPDATE uploads SET state=? WHERE uploadid=?", (state, uploadid))
+
+    def get_upload(self, uploadid):
+        row = self.execute("SELECT * FROM uploads WHERE uploadid=?", (uploadid,)).fetchone()
+        if row is not None:
+            row = dict(row)
+        return row
+
+    def get_project_uploads(self, projectid):
+        return [row[0] for row in self.execute("SELECT uploadid FROM uploads WHERE projectid=?", (projectid,)).fetchall()]
+
+    def get_stale_uploads(self, before):
+        return [row[0] for row in self.execute("SELECT uploadid FROM uploads WHERE created<?", (before,)).fetchall()]
+
+    def delete_upload(self, uploadid):
+        self.execute("DELETE FROM uploads WHERE uploadid=?", (uploadid,))
+
     def delete_tasks(self, projectid):
         year = self.get_project(projectid, fields=["year"])["year"]
         tasktable = "T{}".format(year)
@@ -761,7 +963,7 @@ class ProjectDB(sqlite.Connection):
                   "( taskid INTEGER, projectid VARCHAR(36), editing VARCHAR(30), editor VARCHAR(30), speaker VARCHAR(128), "
                   "start REAL, end REAL, language VARCHAR(20), "
                   "textfile VARCHAR(64), creation REAL, modified REAL, commitid VARCHAR(40), "
-                  "completed REAL, jobid VARCHAR(36), errstatus VARCHAR(128) )" )
+                  "completed REAL, jobid VARCHAR(36), errstatus VARCHAR(128), audiostatus VARCHAR(30) )" )
         self.execute(query)
 
     def insert_incoming(self, projectid, url, servicetype):
@@ -803,6 +1005,139 @@ class ProjectDB(sqlite.Connection):
         return row
         
 ########## Helper funcs/classes
+def render_task_audio(projectdb, projectid, audiofile, tasks):
+    """Background job: render the normalised audio segment of each task
+       into the task's directory (in each quality), recording progress in `audiostatus`
+       ("pending" -> "rendering" -> "done" or "error").
+    """
+    db = sqlite.connect(projectdb, factory=ProjectDB)
+    db.row_factory = sqlite.Row
+    try:
+        for task in tasks:
+            with db:
+                db.update_tasks(projectid, [dict(task, audiostatus="rendering")], fields=["audiostatus"])
+            status = "done"
+            for quality in audio.QUALITIES:
+                taskaudio = audio.task_audio_path(os.path.dirname(task["textfile"]), quality)
+                tmpfile = "{}.tmp".format(taskaudio)
+                try:
+                    audio.transcode(audiofile, tmpfile, (task["start"], task["end"]), quality, background=True)
+                    os.rename(tmpfile, taskaudio)
+                except Exception as e:
+                    LOG.error("(projectid={} taskid={}) Rendering task audio ({}) failed: {}".format(projectid, task["taskid"], quality, e))
+                    if os.path.exists(tmpfile):
+                        os.remove(tmpfile)
+                    status = "error"
+            with db:
+                db.update_tasks(projectid, [dict(task, audiostatus=status)], fields=["audiostatus"])
+        LOG.info("(projectid={}) Rendered audio for {} tasks".format(projectid, len(tasks)))
+    finally:
+        db.close()
+
+def ingest_audio(projectdb, storedir, projectid, jobid, audiofile, prevfiles, prevhash):
+    """Background job: validate uploaded `audiofile`, add it to the audio
+       store (sharing renditions, page index and waveform peaks with
+       identical earlier uploads, else creating them) and make it the
+       project's audio, removing `prevfiles` and releasing `prevhash`.
+       On failure `errstatus` is set. Results are discarded if the
+       project was unlocked (or deleted) in the meantime, i.e. no longer
+       has `jobid`.
+    """
+    def owned(db):
+        db.lock()
+        row = db.get_project(projectid, ["jobid"])
+        return row.get("jobid") == jobid #empty if deleted
+
+    store = audiostore.AudioStore(storedir)
+    digest = None
+    db = sqlite.connect(projectdb, factory=ProjectDB)
+    db.row_factory = sqlite.Row
+    try:
+        try:
+            size, digest = audiostore.sha256_file(audiofile)
+            with store.lock(digest) as blob:
+                store.add(audiofile, digest)
+                #Probe file type, encoding and channels in a single pass over
+                #the page headers, which also indexes pages for segment extraction
+                try:
+                    audiometa = oggindex.OggIndex.for_file(blob).metadata()
+                except ValueError as e:
+                    LOG.info("(projectid={}) Probe failed: {}".format(projectid, e))
+                    raise BadRequestError("Only OGG Vorbis audio supported! Re-encode audio file.")
+                if audiometa["channels"] != 1:
+                    raise BadRequestError("Only single channel audio supported! Split channels into separate files.")
+                #Create normalised renditions
+                for quality in audio.QUALITIES:
+                    rendition = audio.rendition_path(blob, quality)
+                    if not os.path.exists(rendition):
+                        audio.transcode(blob, "{}.tmp".format(rendition), quality=quality, background=True)
+                        os.rename("{}.tmp".format(rendition), rendition)
+                #Waveform peaks for the editor
+                if not os.path.exists(audio.peaks_path(blob)):
+                    audio.Peaks.compute(blob).save(audio.peaks_path(blob))
+                store.link_derived(blob, audiofile)
+
+            #Update fields and unlock project
+            with db:
+                if not owned(db):
+                    LOG.warning("(projectid={}) Upload {} superseded: discarding audio".format(projectid, jobid))
+                    audio.remove_audio(audiofile)
+                    store.release(digest)
+                    return
+                db.update_project(projectid, {"audiofile": audiofile, "audiodur": audiometa["duration"],
+                                              "normaudiofile": audio.rendition_path(audiofile),
+                                              "audiometa": json.dumps(audiometa),
+                                              "audiohash": digest})
+                db.delete_tasks(projectid)
+                db.unlock_project(projectid)
+        except Exception as e:
+            LOG.error("(projectid={}) Audio ingest failed: {}".format(projectid, e))
+            with db:
+                if owned(db):
+                    db.unlock_project(projectid, errstatus="upload audio error: {}".format(e))
+            audio.remove_audio(audiofile)
+            if digest is not None:
+                store.release(digest)
+            return
+        #Remove previous audiofile if it exists
+        for filename in prevfiles:
+            if filename:
+                audio.remove_audio(filename)
+        store.release(prevhash)
+        LOG.info("(projectid={}) Audio ingested: {} ({})".format(projectid, audiofile, digest))
+    finally:
+        db.close()
+
+def release_spurious_audio(store, projectpath, keep):
+    """Remove uploaded audio files in `projectpath` other than `keep`
+       (left behind by ingest jobs that did not finish) and release their
+       blobs in `store`
+    """
+    try:
+        names = os.listdir(projectpath)
+    except OSError:
+        return
+    for name in names:
+        filename = os.path.join(projectpath, name)
+        #Derived and temporary files have an extension, uploads do not
+        if "." in name or filename == keep or not os.path.isfile(filename):
+            continue
+        size, digest = audiostore.sha256_file(filename)
+        LOG.info("Removing spurious audio {} ({})".format(filename, digest))
+        audio.remove_audio(filename)
+        store.release(digest)
+
+def nchunks(size, chunksize):
+    return (size + chunksize - 1) // chunksize
+
+def received_chunks(updir):
+    chunks = []
+    for name in os.listdir(updir):
+        num, ext = os.path.splitext(name)
+        if ext == ".chunk" and num.isdigit():
+            chunks.append(int(num))
+    return sorted(chunks)
+
 def approx_eq(a, b, epsilon=0.01):
     return abs(a - b) < epsilon
 
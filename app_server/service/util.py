@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Small helpers shared by the service modules
+"""
+from __future__ import unicode_literals, division, print_function #Py2
+
+import os
+import errno
+try:
+    import uwsgi #Only available when running under uWSGI
+except ImportError:
+    uwsgi = None
+
+def makedirs(path):
+    """Create directory `path` (and parents) unless it exists
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def worker_id():
+    """ID of this uWSGI worker (process ID outside uWSGI)
+    """
+    if uwsgi is not None:
+        return uwsgi.worker_id()
+    return os.getpid()
+
+
+class ProcessGlobal(object):
+    """Process-wide instance of `cls`, (re)created with `configure()`
+       (e.g. from a section in dispatcher.json) or with the defaults on
+       first `get()`
+    """
+    def __init__(self, cls):
+        self._cls = cls
+        self._instance = None
+
+    def configure(self, **kwargs):
+        self._instance = self._cls(**kwargs)
+
+    def get(self):
+        if self._instance is None:
+            self.configure()
+        return self._instance
@@ -17,6 +17,26 @@ except ImportError:
 
 import bcrypt #Ubuntu/Debian: apt-get install python-bcrypt
 
+#Generation counter, incremented whenever tokens may have been
+#invalidated: lets application server workers expire cached tokens
+GENERATION_SCHEMA = ["CREATE TABLE authgen (generation INTEGER)",
+                     "INSERT INTO authgen (generation) VALUES (0)",
+                     "CREATE TRIGGER authgen_tokens_delete AFTER DELETE ON tokens BEGIN UPDATE authgen SET generation = generation + 1; END",
+                     "CREATE TRIGGER authgen_users_delete AFTER DELETE ON users BEGIN UPDATE authgen SET generation = generation + 1; END",
+                     "CREATE TRIGGER authgen_users_role AFTER UPDATE OF role ON users BEGIN UPDATE authgen SET generation = generation + 1; END"]
+
+#Signed tokens of a user issued before `before` are revoked: recorded
+#whenever tokens may have been invalidated (see GENERATION_SCHEMA)
+REVOCATION_NOW = "(julianday('now') - 2440587.5) * 86400.0" #Unix time
+REVOCATION_SCHEMA = ["CREATE TABLE revoked (username VARCHAR(30) PRIMARY KEY, before TIMESTAMP)",
+                     "CREATE TRIGGER revoked_tokens_delete AFTER DELETE ON tokens BEGIN INSERT OR REPLACE INTO revoked (username, before) VALUES (old.username, {}); END".format(REVOCATION_NOW),
+                     "CREATE TRIGGER revoked_users_delete AFTER DELETE ON users BEGIN INSERT OR REPLACE INTO revoked (username, before) VALUES (old.username, {}); END".format(REVOCATION_NOW),
+                     "CREATE TRIGGER revoked_users_role AFTER UPDATE OF role ON users BEGIN INSERT OR REPLACE INTO revoked (username, before) VALUES (new.username, {}); END".format(REVOCATION_NOW)]
+
+#Indexes for token lookup by user (login) and expired token removal
+INDEX_SCHEMA = ["CREATE INDEX IF NOT EXISTS tokens_username ON tokens (username)",
+                "CREATE INDEX IF NOT EXISTS tokens_expiry ON tokens (expiry)"]
+
 def create_new_db(dbfn):
     db_conn = sqlite.connect(dbfn)
     db_curs = db_conn.cursor()
@@ -31,6 +51,26 @@ def create_new_db(dbfn):
     db_curs.execute("CREATE TABLE tokens ({})".format(", ".join(["token VARCHAR(20) PRIMARY KEY",
                                                                  "username VARCHAR(30)", "role VARCHAR(128)",
                                                                  "expiry TIMESTAMP"])))
+    for statement in GENERATION_SCHEMA + REVOCATION_SCHEMA + INDEX_SCHEMA:
+        db_curs.execute(statement)
+    db_conn.commit()
+    return db_conn
+
+def upgrade_db(dbfn):
+    """Add tables and indexes introduced since the DB was created
+    """
+    db_conn = sqlite.connect(dbfn)
+    db_curs = db_conn.cursor()
+    if not db_curs.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='authgen'").fetchone():
+        print("Adding table: authgen")
+        for statement in GENERATION_SCHEMA:
+            db_curs.execute(statement)
+    if not db_curs.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='revoked'").fetchone():
+        print("Adding table: revoked")
+        for statement in REVOCATION_SCHEMA:
+            db_curs.execute(statement)
+    for statement in INDEX_SCHEMA:
+        db_curs.execute(statement)
     db_conn.commit()
     return db_conn
 
@@ -39,12 +79,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("outfn", metavar="OUTFN", type=str, help="Output DB filename.")
     parser.add_argument("--rootpass", metavar="ROOTPASS", type=str, default=None, help="Password for default user 'root'.")
+    parser.add_argument("--upgrade", action="store_true", help="Upgrade the schema of an existing DB.")
     args = parser.parse_args()
     outfn = args.outfn
 
-    db_conn = create_new_db(outfn)
+    if args.upgrade:
+        db_conn = upgrade_db(outfn)
+    else:
+        db_conn = create_new_db(outfn)
 
-    if args.rootpass is not None:
+    if args.rootpass is not None and not args.upgrade:
         try:
             salt = bcrypt.gensalt(prefix=b"2a")
         except:
@@ -23,6 +23,10 @@ BASEURL = "http://127.0.0.1:9999/wsgi/"
 USERNO = 1
 RANDOM_WAIT_LOW = 0.2
 RANDOM_WAIT_HIGH = 0.3
+PEAKS_RETRIES = 30 #while waveform peaks are computed in the background
+PEAKS_RETRY_WAIT = 2.0 #seconds
+INGEST_TIMEOUT = 300.0 #seconds to wait for an uploaded audio file to be processed
+INGEST_POLL = 1.0 #seconds
 
 # Readline modes
 readline.parse_and_bind('tab: complete')
@@ -195,7 +199,7 @@ class Project:
 
     def uploadaudio(self):
         """
-            Upload audio to project
+            Upload audio to project and wait until it has been processed
             Requires tallship.ogg to be located in current location
         """
         if not os.path.exists('tallship.ogg'):
@@ -207,9 +211,33 @@ class Project:
             res = requests.post(BASEURL + "projects/uploadaudio", files=files)
             LOG.info('uploadaudio(): SERVER SAYS:{}'.format(res.text))
             LOG.info(res.status_code)
+            if res.status_code == 200:
+                self.waitaudio(res.json()["jobid"])
         else:
             LOG.info("User not logged in!")
 
+    def waitaudio(self, jobid):
+        """
+            Poll the project until the background processing of uploaded
+            audio (locking the project with `jobid`) is done
+        """
+        headers = {"Content-Type" : "application/json"}
+        data = {"token": self.user_token}
+        deadline = time.time() + INGEST_TIMEOUT
+        while True:
+            res = requests.post(BASEURL + "projects/listcreatedprojects", headers=headers, data=json.dumps(data))
+            projects = [p for p in res.json()["projects"] if p["projectid"] == self.projectid]
+            if not projects or projects[0]["jobid"] != jobid:
+                break
+            if time.time() > deadline:
+                LOG.error("Timed out waiting for audio upload to be processed")
+                return
+            time.sleep(INGEST_POLL)
+        if projects and projects[0]["errstatus"]:
+            LOG.error('waitaudio(): AUDIO PROCESSING FAILED:{}'.format(projects[0]["errstatus"]))
+        else:
+            LOG.info('waitaudio(): Audio processed')
+
     def saveproject(self):
         """
             Save tasks for a specific project
@@ -486,6 +514,33 @@ class Editor:
             LOG.error("username={}: getaudio(): User not logged in!".format(self.username))
         print('')
 
+    def getpeaks(self):
+        """
+            Return waveform peaks for the task, retrying while the server
+            computes them in the background (409)
+        """
+        LOG.info("username={}: getpeaks(): Entering".format(self.username))
+        if self.user_token is not None and self.projectid is not None:
+            params = {'token' : self.user_token, 'projectid' : self.projectid, 'taskid' : self.taskid}
+            for attempt in range(PEAKS_RETRIES):
+                res = requests.get(BASEURL + "editor/getpeaks", params=params)
+                if res.status_code != 409:
+                    break
+                LOG.info("username={}: getpeaks(): Peaks not ready, retrying".format(self.username))
+                time.sleep(PEAKS_RETRY_WAIT)
+            print(res.status_code)
+            if res.status_code == 200:
+                pkg = res.json()
+                print('PEAKS: {} from {}s ({} samples per peak)'.format(len(pkg["peaks"]), pkg["start"], pkg["samplesperpeak"]))
+                LOG.info("username={}: getpeaks(): {} peaks".format(self.username, len(pkg["peaks"])))
+            else:
+                print('SERVER SAYS:', res.text)
+                LOG.error("username={}: getpeaks(): {}".format(self.username, res.text))
+        else:
+            print("User not logged in!")
+            LOG.error("username={}: getpeaks(): User not logged in!".format(self.username))
+        print('')
+
     def savetext(self):
         """
             Save text to task text file
@@ -808,6 +863,7 @@ if __name__ == "__main__":
 
         print("Editor specific - (need to provide a user name)")
         print("GETAUDIO - return task audio")
+        print("GETPEAKS - return task waveform peaks")
         print("GETTEXT - return task text")
         print("SAVETEXT - save text to file")
         print("CLEARTEXT - remove text from file")
@@ -935,6 +991,12 @@ if __name__ == "__main__":
             edit.getaudio()
             edit.logout()
 
+        elif sys.argv[1].upper() == "GETPEAKS":
+            edit.login(sys.argv[2])
+            edit.loadtasks()
+            edit.getpeaks()
+            edit.logout()
+
         elif sys.argv[1].upper() == "TASKDONE":
             edit.login(sys.argv[2])
             edit.loadtasks()
@@ -16,6 +16,7 @@ import os
 import tempfile
 import logging
 import codecs
+import hashlib
 from collections import OrderedDict
 try:
     from sqlite3 import dbapi2 as sqlite
@@ -35,6 +36,9 @@ DEF_NUSERS = 40
 DEF_NPROCS = 40
 DEF_MINDELAY = 20.0 #seconds
 DEF_MAXDELAY = 60.0 #seconds
+INGEST_TIMEOUT = 300.0 #seconds to wait for an uploaded audio file to be processed
+INGEST_POLL = 1.0 #seconds
+UPLOAD_CHUNKSIZE = 1024 * 1024 #bytes per chunk in chunked uploads
 
 ################################################################################
 def setuplog(logname, logfile, loglevel, tid):
@@ -72,6 +76,7 @@ class Test:
         self.__dict__ = testdata
         self.baseurl = baseurl
         self.seed = seed
+        self.uploadid = None
         LOG.info("SEED: {}".format(self.seed))
         self.state = {"u_notloggedin": True,
                       "u_loggedin": False,
@@ -361,6 +366,94 @@ class Test:
         LOG.info("SERVMESG: {}".format(result.text))
         if result.status_code != 200:
             raise RequestFailed(result.text)
+        #Audio is processed in the background: the project stays locked
+        #with the returned jobid until done
+        self.waitaudio(data["token"], data["projectid"], result.json()["jobid"])
+        self.state["p_hasaudio"] = True
+        self.state["p_saved"] = False
+
+    def waitaudio(self, token, projectid, jobid, timeout=INGEST_TIMEOUT):
+        LOG.debug("ENTER")
+        data = {"token": token}
+        deadline = time.time() + timeout
+        while True:
+            result = post("projects/listcreatedprojects", data)
+            if result.status_code != 200:
+                raise RequestFailed(result.text)
+            project = [p for p in result.json()["projects"] if p["projectid"] == projectid]
+            if not project:
+                raise RequestFailed("Project not found: {}".format(projectid))
+            project = project[0]
+            if project["jobid"] != jobid:
+                break
+            if time.time() > deadline:
+                raise RequestFailed("Timed out waiting for audio upload to be processed")
+            time.sleep(INGEST_POLL)
+        LOG.info("INGESTSTAT: {}".format(project["errstatus"]))
+        if project["errstatus"]:
+            raise RequestFailed(project["errstatus"])
+
+    def openupload(self, token=None, projectid=None, filename=None, chunksize=UPLOAD_CHUNKSIZE):
+        LOG.debug("ENTER")
+        data = {"token": token or self.token,
+                "projectid": projectid or self.pid,
+                "filename": os.path.basename(filename or self.audiofile),
+                "size": os.path.getsize(filename or self.audiofile),
+                "chunksize": chunksize}
+        result = post("projects/openupload", data)
+        LOG.info("SERVSTAT: {}".format(result.status_code))
+        LOG.info("SERVMESG: {}".format(result.text))
+        if result.status_code != 200:
+            raise RequestFailed(result.text)
+        self.uploadid = result.json()["uploadid"]
+        self.uploadchunksize = chunksize
+
+    def uploadchunk(self, token=None, uploadid=None, filename=None, chunknos=None):
+        """Send chunks `chunknos` (default all) of the open upload
+        """
+        LOG.debug("ENTER")
+        uploadid = uploadid or self.uploadid
+        chunksize = self.uploadchunksize
+        with open(filename or self.audiofile, "rb") as f:
+            if chunknos is None:
+                chunknos = range((os.fstat(f.fileno()).st_size + chunksize - 1) // chunksize)
+            for chunkno in chunknos:
+                f.seek(chunkno * chunksize)
+                chunk = f.read(chunksize)
+                data = {"token": token or self.token,
+                        "uploadid": uploadid,
+                        "chunkno": chunkno,
+                        "checksum": hashlib.sha256(chunk).hexdigest()}
+                result = requests.put(os.path.join(self.baseurl, "projects/uploadchunk"), data=data,
+                                      files={"file": ("{}.chunk".format(chunkno), chunk)})
+                LOG.info("SERVSTAT: {}".format(result.status_code))
+                LOG.info("SERVMESG: {}".format(result.text))
+                if result.status_code != 200:
+                    raise RequestFailed(result.text)
+
+    def uploadstatus(self, token=None, uploadid=None):
+        LOG.debug("ENTER")
+        data = {"token": token or self.token,
+                "uploadid": uploadid or self.uploadid}
+        result = requests.get(os.path.join(self.baseurl, "projects/uploadstatus"), params=data)
+        LOG.info("SERVSTAT: {}".format(result.status_code))
+        LOG.info("SERVMESG: {}".format(result.text))
+        if result.status_code != 200:
+            raise RequestFailed(result.text)
+        return result.json()
+
+    def finalizeupload(self, token=None, uploadid=None):
+        LOG.debug("ENTER")
+        data = {"token": token or self.token,
+                "uploadid": uploadid or self.uploadid}
+        result = post("projects/finalizeupload", data)
+        LOG.info("SERVSTAT: {}".format(result.status_code))
+        LOG.info("SERVMESG: {}".format(result.text))
+        if result.status_code != 200:
+            raise RequestFailed(result.text)
+        self.uploadid = None
+        #Processed in the background as in uploadaudio
+        self.waitaudio(data["token"], self.pid, result.json()["jobid"])
         self.state["p_hasaudio"] = True
         self.state["p_saved"] = False
 
@@ -596,6 +689,10 @@ if __name__ == "__main__":
                     print("LOADUSERS - load users")
                     print("LOADPROJECT - load projects")
                     print("UPLOADAUDIO - upload audio to project")
+                    print("OPENUPLOAD - start a chunked audio upload to project")
+                    print("UPLOADCHUNK - send all chunks of the chunked upload")
+                    print("UPLOADSTATUS - list chunks received by the server")
+                    print("FINALIZEUPLOAD - complete the chunked upload")
                     print("GETAUDIO - retrieve project audio")
                     print("SAVEPROJECT - update project and create/save tasks for a project")
                     print("ASSIGNTASKS - assign tasks to editors")
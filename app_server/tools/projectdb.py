@@ -14,28 +14,40 @@ try:
 except ImportError:
     from pysqlite2 import dbapi2 as sqlite #for old Python versions
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("outfn", metavar="OUTFN", type=str, help="Output DB filename.")
-    args = parser.parse_args()
-    outfn = args.outfn
-    
-    db_conn = sqlite.connect(outfn)
+PROJECT_FIELDS = ["projectid VARCHAR(36) PRIMARY KEY",
+                  "projectname VARCHAR(32)",
+                  "category VARCHAR(36)",
+                  "creator VARCHAR(30)",
+                  "projectmanager VARCHAR(30)",
+                  "collator VARCHAR(30)",
+                  "audiofile VARCHAR(128)",
+                  "audiodur REAL",
+                  "year INTEGER",
+                  "creation REAL",
+                  "assigned VARCHAR(1)",
+                  "jobid VARCHAR(36)",
+                  "projectstatus VARCHAR(30)",
+                  "errstatus VARCHAR(128)",
+                  "normaudiofile VARCHAR(128)",
+                  "audiometa TEXT",
+                  "audiohash VARCHAR(64)"]
+
+#Columns added to the yearly task tables (T<year>) since they were introduced
+TASK_UPGRADE_FIELDS = ["audiostatus VARCHAR(30)"]
+
+UPLOAD_FIELDS = ["uploadid VARCHAR(36) PRIMARY KEY",
+                 "projectid VARCHAR(36)",
+                 "username VARCHAR(30)",
+                 "filename VARCHAR(128)",
+                 "size INTEGER",
+                 "chunksize INTEGER",
+                 "created REAL",
+                 "state VARCHAR(16)"]
+
+def create_new_db(dbfn):
+    db_conn = sqlite.connect(dbfn)
     db_curs = db_conn.cursor()
-    db_curs.execute("CREATE TABLE projects ({})".format(", ".join(["projectid VARCHAR(36) PRIMARY KEY",
-                                                                   "projectname VARCHAR(32)",
-                                                                   "category VARCHAR(36)",
-                                                                   "creator VARCHAR(30)",
-                                                                   "projectmanager VARCHAR(30)",
-                                                                   "collator VARCHAR(30)",
-                                                                   "audiofile VARCHAR(128)",
-                                                                   "audiodur REAL",
-                                                                   "year INTEGER",
-                                                                   "creation REAL",
-                                                                   "assigned VARCHAR(1)",
-                                                                   "jobid VARCHAR(36)",
-                                                                   "projectstatus VARCHAR(30)",
-                                                                   "errstatus VARCHAR(128)"])))
+    db_curs.execute("CREATE TABLE projects ({})".format(", ".join(PROJECT_FIELDS)))
     db_curs.execute("CREATE TABLE incoming ({})".format(", ".join(["projectid VARCHAR(36)",
                                                                    "taskid INTEGER",
                                                                    "url VARCHAR(128)",
@@ -47,5 +59,47 @@ if __name__ == "__main__":
                                                                    "end REAL"])))
     db_curs.execute("CREATE TABLE message ({})".format(", ".join(["key VARCHAR(36)",
                                                                   "message VARCHAR(128)"])))
+    db_curs.execute("CREATE TABLE uploads ({})".format(", ".join(UPLOAD_FIELDS)))
     db_conn.commit()
+    return db_conn
+
+def upgrade_db(dbfn):
+    """Add tables and columns introduced since the DB was created
+    """
+    db_conn = sqlite.connect(dbfn)
+    db_curs = db_conn.cursor()
+    existing = set(row[1] for row in db_curs.execute("PRAGMA table_info(projects)").fetchall())
+    for field in PROJECT_FIELDS:
+        if field.split()[0] not in existing:
+            print("Adding column to projects: {}".format(field))
+            db_curs.execute("ALTER TABLE projects ADD COLUMN {}".format(field))
+    if not db_curs.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='uploads'").fetchone():
+        print("Adding table: uploads")
+        db_curs.execute("CREATE TABLE uploads ({})".format(", ".join(UPLOAD_FIELDS)))
+    existing = set(row[1] for row in db_curs.execute("PRAGMA table_info(uploads)").fetchall())
+    for field in UPLOAD_FIELDS:
+        if field.split()[0] not in existing:
+            print("Adding column to uploads: {}".format(field))
+            db_curs.execute("ALTER TABLE uploads ADD COLUMN {}".format(field))
+    tasktables = [row[0] for row in db_curs.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'T%'").fetchall()]
+    for table in tasktables:
+        existing = set(row[1] for row in db_curs.execute("PRAGMA table_info({})".format(table)).fetchall())
+        for field in TASK_UPGRADE_FIELDS:
+            if field.split()[0] not in existing:
+                print("Adding column to {}: {}".format(table, field))
+                db_curs.execute("ALTER TABLE {} ADD COLUMN {}".format(table, field))
+    db_conn.commit()
+    return db_conn
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("outfn", metavar="OUTFN", type=str, help="Output DB filename.")
+    parser.add_argument("--upgrade", action="store_true", help="Upgrade the schema of an existing DB.")
+    args = parser.parse_args()
+    outfn = args.outfn
 
+    if args.upgrade:
+        upgrade_db(outfn)
+    else:
+        create_new_db(outfn)
@@ -5,54 +5,44 @@ from __future__ import unicode_literals, division, print_function, with_statemen
 
 import sys
 import os
+import time
 import uwsgi
 import json
+import codecs
 import logging
-import logging.handlers
-import subprocess
-import datetime
-import math
 import fcntl
-import tempfile
+import zlib
+try:
+    import brotli #Optional: pip install brotli
+except ImportError:
+    brotli = None
 
 from dispatcher import Dispatch
 from service.httperrs import *
+from service import audio
+from service import limiter
+from service import conditional
+from service import metrics
+from service import profiler
+from service import applog
+from service import auth
 
-# Check binaries are installed
-MP3SPLT="/usr/bin/mp3splt"; assert os.stat(MP3SPLT)
-OGGENC="/usr/bin/oggenc"; assert os.stat(OGGENC)
-OGGDEC="/usr/bin/oggdec"; assert os.stat(OGGDEC)
-SOX="/usr/bin/sox"; assert(os.stat(SOX))
-
-#SETUP LOGGING
-
-#The following ensures that we can override "funcName" when logging
-# from wrapper functions, from:
-# http://stackoverflow.com/questions/7003898/using-functools-wraps-with-a-logging-decorator
-class CustomFormatter(logging.Formatter):
-    """Custom formatter, overrides funcName with value of funcname if it
-       exists
-    """
-    def format(self, record):
-        if hasattr(record, 'funcname'):
-            record.funcName = record.funcname
-        return super(CustomFormatter, self).format(record)
+with codecs.open(os.environ['services_config'], 'r', 'utf-8') as infh:
+    CONFIG = json.load(infh)
 
+#SETUP LOGGING (queued, written by a background thread in each worker)
 LOGNAME = "APP"
-LOGFNAME = os.path.join(os.getenv("PERSISTENT_FS"), "appserver.log")
-LOGLEVEL = logging.DEBUG
+LOGCONFIG = {"dir" : os.getenv("PERSISTENT_FS"),
+             "filename" : "appserver.log",
+             "format" : "%(asctime)s [%(levelname)s] %(name)s in %(funcName)s(): %(message)s",
+             "level" : "DEBUG"}
+LOGCONFIG.update(CONFIG.get("logging", {}))
 try:
-    fmt = "%(asctime)s [%(levelname)s] %(name)s in %(funcName)s(): %(message)s"
     LOG = logging.getLogger(LOGNAME)
-    formatter = CustomFormatter(fmt)
-    ofstream = logging.handlers.TimedRotatingFileHandler(LOGFNAME, when="D", interval=1, encoding="utf-8")
-    ofstream.setFormatter(formatter)
-    LOG.addHandler(ofstream)
-    LOG.setLevel(LOGLEVEL)
-    #If we want console output:
-    # console = logging.StreamHandler()
-    # console.setFormatter(formatter)
-    # LOG.addHandler(console)
+    LOGHANDLER = applog.configure(LOGNAME,
+                                  os.path.join(LOGCONFIG.pop("dir"), LOGCONFIG.pop("filename")),
+                                  LOGCONFIG.pop("format"),
+                                  **LOGCONFIG)
 except Exception as e:
     print("FATAL ERROR: Could not create logging instance: {}".format(e), file=sys.stderr)
     sys.exit(1)
@@ -61,13 +51,75 @@ except Exception as e:
 router = Dispatch(os.environ['services_config'])
 router.load()
 
+#SETUP AUDIO SEGMENT CACHE
+AUDIOCACHE = audio.SegmentCache(CONFIG.get("audiocache", {}).get("dir", os.path.join(os.getenv("PERSISTENT_FS"), "audiocache")),
+                                CONFIG.get("audiocache", {}).get("maxsize", 2 * 1024**3))
+
+#SETUP SUBPROCESS PIPELINE LIMITER (shared by all workers)
+limiter.configure(**CONFIG.get("limiter", {}))
+
+#SETUP RESPONSE COMPRESSION
+COMPRESSION = {"minsize" : 1024, "level" : 6, "brotli" : True}
+COMPRESSION.update(CONFIG.get("compression", {}))
+
+#SETUP REQUEST METRICS (per-worker snapshots, aggregated when scraped)
+metrics.configure(**CONFIG.get("metrics", {}))
+metrics.get().clear() #This is loaded by the master before forking workers
+metrics.get().add_gauge("stp_workers", "uWSGI workers.", lambda: len(uwsgi.workers()))
+metrics.get().add_gauge("stp_workers_busy", "uWSGI workers processing a request.",
+                        lambda: sum(1 for worker in uwsgi.workers() if worker["status"] == "busy"))
+
+#SETUP REQUEST PROFILER (opt-in, toggled for all workers by the admin service)
+profiler.configure(**CONFIG.get("profiler", {}))
+profiler.get().reset()
+
+#RELOAD SERVICES WHEN CONFIG FILES CHANGE (e.g. `touch config/dispatcher.json`)
+RELOAD_SIGNAL = 17
+def reload_services(signum):
+    router.reload()
+try:
+    uwsgi.register_signal(RELOAD_SIGNAL, "workers", reload_services)
+    for config_file in router.config_files():
+        uwsgi.add_file_monitor(RELOAD_SIGNAL, config_file)
+except Exception as e:
+    LOG.warning("Could not set up config reload: {}".format(e))
+
+#PERIODICALLY REMOVE EXPIRED LOGIN TOKENS (in one worker)
+SWEEP_SIGNAL = 18
+def sweep_tokens(signum):
+    for authdb in router.auth_dbs():
+        try:
+            LOG.info("Removed {} expired tokens from {}".format(auth.sweep_tokens(authdb), authdb))
+        except Exception as e:
+            LOG.error("Could not remove expired tokens from {}: {}".format(authdb, e))
+try:
+    uwsgi.register_signal(SWEEP_SIGNAL, "worker", sweep_tokens)
+    uwsgi.add_timer(SWEEP_SIGNAL, int(CONFIG.get("tokensweep", {}).get("interval", 3600)))
+except Exception as e:
+    LOG.warning("Could not set up expired token removal: {}".format(e))
+
 #PERFORM CLEANUP WHEN SERVER SHUTDOWN
 def app_shutdown():
     LOG.info('Shutting down subsystem instance...')
     sys.stdout.flush()
+    metrics.get().flush()
     router.shutdown()
+    LOGHANDLER.flush()
 uwsgi.atexit = app_shutdown
 
+#Stop this (master) process's log writer so that no thread holds a
+#logging lock when workers are forked
+LOGHANDLER.flush()
+
+def pop_validators(d):
+    """Remove validators returned by a service method from result `d`,
+       returning them as response headers. The entity tag is weak as it
+       is shared by all content-codings of the response.
+    """
+    if "etag" not in d:
+        return []
+    return conditional.headers(conditional.weak(d.pop("etag")), d.pop("lastmodified", None))
+
 def build_json_response(data):
     if type(data) is dict:
         response = json.dumps(data)
@@ -76,124 +128,312 @@ def build_json_response(data):
     response_header = [('Content-Type','application/json'), ('Content-Length', str(len(response)))]
     return response, response_header
 
-def fix_oggsplt_time(realtime):
-    """ Convert seconds to weird MP3splt time format XX:XX:XX.XX
+def accepted_encodings(header):
+    """Content codings acceptable according to an `Accept-Encoding`
+       header, mapped to their q-values
+    """
+    encodings = {}
+    for item in header.split(","):
+        coding, sep, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, sep, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        encodings[coding] = q
+    return encodings
+
+def compress_response(env, response, response_header):
+    """Compress `response` with brotli or gzip if the client accepts it
+       and it is at least `minsize` bytes
+    """
+    response_header = response_header + [("Vary", "Accept-Encoding")]
+    if len(response) < COMPRESSION["minsize"]:
+        return response, response_header
+    accepted = accepted_encodings(env.get("HTTP_ACCEPT_ENCODING", ""))
+    def acceptable(coding):
+        return accepted.get(coding, accepted.get("*", 0.0)) > 0.0
+    if brotli is not None and COMPRESSION["brotli"] and acceptable("br"):
+        coding = "br"
+        response = brotli.compress(response, quality=min(COMPRESSION["level"], 11))
+    elif acceptable("gzip"):
+        coding = "gzip"
+        compressor = zlib.compressobj(COMPRESSION["level"], zlib.DEFLATED, 16 + zlib.MAX_WBITS) #gzip container
+        response = compressor.compress(response) + compressor.flush()
+    else:
+        return response, response_header
+    response_header = [(k, v) for k, v in response_header if k != "Content-Length"]
+    response_header.extend([("Content-Encoding", coding), ("Content-Length", str(len(response)))])
+    return response, response_header
+
+def json_response(env, data):
+    """Build (negotiably compressed) JSON response for service result `data`
+    """
+    validators = pop_validators(data)
+    response, response_header = build_json_response(data)
+    response, response_header = compress_response(env, response, response_header)
+    return response, response_header + validators
+
+class ResponseFile(object):
+    """Read-only file handed to the server to stream a response body
+       (`filename` or the already open `fh`), optionally removing the
+       file when the server closes it
     """
-    dt = datetime.timedelta(seconds=float(realtime))
-    dts = str(dt)
-    (hour, minute, second) = dts.split(":")
-    minute = int(60.0 * float(hour) + float(minute))
-    second = int(math.ceil(float(second)))
-    return "{}.{}".format(minute, second)
+    def __init__(self, filename, delete=False, fh=None):
+        self._filename = filename
+        self._delete = delete
+        self._fh = fh or open(filename, "rb")
+        self.size = os.fstat(self._fh.fileno()).st_size
+        self.length = self.size
+        self.partial = False
+
+    def set_range(self, first, last):
+        """Restrict reads to bytes `first` to `last` (inclusive)
+        """
+        self._fh.seek(first)
+        self.length = last - first + 1
+        self.partial = True
+
+    def read(self, size=-1):
+        if size < 0 or size > self.length:
+            size = self.length
+        data = self._fh.read(size)
+        self.length -= len(data)
+        return data
+
+    def fileno(self):
+        return self._fh.fileno()
+
+    def close(self):
+        if not self._fh.closed:
+            self._fh.close()
+            if self._delete:
+                os.remove(self._filename)
+
+def _iter_file(filelike, blocksize):
+    try:
+        while True:
+            block = filelike.read(blocksize)
+            if not block:
+                break
+            yield block
+    finally:
+        filelike.close()
+
+def file_response(env, filelike, blocksize=64*1024):
+    """Stream `filelike` with constant memory, using the server's
+       `wsgi.file_wrapper` if available (whole files only: the wrapper
+       may send from the file descriptor directly)
+    """
+    if "wsgi.file_wrapper" in env and not filelike.partial:
+        return env["wsgi.file_wrapper"](filelike, blocksize)
+    return _iter_file(filelike, blocksize)
+
+def parse_range(header, size):
+    """Parse a `Range` request header for a resource of `size` bytes.
+       Only a single byte range is supported, returns (first, last)
+       or None if the header should be ignored (serve the full
+       resource). Raises ValueError if the range is not satisfiable.
+    """
+    unit, sep, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, sep, last = [part.strip() for part in ranges.strip().partition("-")]
+    if not sep or not (first or last) or not (first + last).isdigit():
+        return None #malformed: ignored (RFC 7233)
+    if size == 0:
+        raise ValueError("Empty resource")
+    if not first: #suffix range: last N bytes
+        length = int(last)
+        if length <= 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - length), size - 1
+    first = int(first)
+    if first >= size:
+        raise ValueError("Range starts beyond end of resource")
+    if not last:
+        return first, size - 1
+    last = int(last)
+    if first > last:
+        return None
+    return first, min(last, size - 1)
 
 # Cross domain access
 ALLOW = [("Access-Control-Allow-Origin", "*"), ("Access-Control-Allow-Methods", "POST, PUT, GET, OPTIONS"),
-        ("Access-Control-Allow-Headers", "Content-Type") ,("Access-Control-Max-Age", "86400"), ('Content-Type','application/json')]
+        ("Access-Control-Allow-Headers", "Content-Type, Range, If-None-Match, If-Modified-Since") ,("Access-Control-Max-Age", "86400"),
+        ("Access-Control-Expose-Headers", "ETag, Last-Modified, Content-Range, Retry-After"), ('Content-Type','application/json')]
+
+class MeteredBody(object):
+    """Response body sent without a Content-Length header: counts the
+       bytes sent and calls `done(size)` once the server closes it
+    """
+    def __init__(self, body, done):
+        self._body = body
+        self._done = done
+        self.size = 0
+
+    def __iter__(self):
+        for block in self._body:
+            self.size += len(block)
+            yield block
+
+    def close(self):
+        try:
+            if hasattr(self._body, "close"):
+                self._body.close()
+        finally:
+            self._done(self.size)
 
 #ENTRY POINT
 def application(env, start_response):
-    LOG.debug("Request: {}".format(env))
+    """Handle request, recording its latency, status and sizes under the
+       route set by the router (see `metrics.ROUTE_KEY`)
+    """
+    method = env['REQUEST_METHOD']
+    started = time.time()
+    metrics.get().begin(method)
+    response = {}
+    def metered_start_response(status, response_header, exc_info=None):
+        response["status"] = status.split(" ", 1)[0]
+        response["length"] = dict(response_header).get("Content-Length")
+        if exc_info is not None:
+            return start_response(status, response_header, exc_info)
+        return start_response(status, response_header)
+    def done(size):
+        metrics.get().end(method, env.get(metrics.ROUTE_KEY, metrics.UNMATCHED), response.get("status", "500"),
+                          time.time() - started, int(env.get("CONTENT_LENGTH") or 0), size)
+    try:
+        if profiler.get().wanted(env['PATH_INFO']):
+            body = profiler.get().run("{} {}".format(method, env['PATH_INFO']), handle_request, env, metered_start_response)
+        else:
+            body = handle_request(env, metered_start_response)
+    except:
+        done(0)
+        raise
+    if type(body) is list:
+        done(sum(len(block) for block in body))
+        return body
+    if response.get("length") is not None: #e.g. files sent by the server
+        done(int(response["length"]))
+        return body
+    return MeteredBody(body, done)
+
+def handle_request(env, start_response):
+    LOG.debug("Request: {} {}".format(env['REQUEST_METHOD'], env['PATH_INFO'])) #not the environment: holds credentials
     try:
         if env['REQUEST_METHOD'] == 'GET':
             d = router.get(env)
-            data = None
             response_header = []
-            tmpin = tempfile.NamedTemporaryFile(delete=False)
-            tmpin.close()
-            tmpout = tempfile.NamedTemporaryFile(delete=False)
-            tmpout.close()
+            delete = False
+            fh = None
+            LOG.info("{}".format(applog.redact(d)))
+            if "mime" not in d: # Send back JSON (e.g. waveform peaks)
+                response, response_header = json_response(env, d)
+                start_response('200 OK', response_header + ALLOW)
+                return [response]
+            if "body" in d: # Send back text (e.g. metrics)
+                response = d["body"].encode("utf-8")
+                start_response('200 OK', [('Content-Type', str(d["mime"])), ('Content-Length', str(len(response)))] +
+                               [h for h in ALLOW if h[0] != "Content-Type"])
+                return [response]
+            #Validators from file identity (or given by the service for
+            #generated files, e.g. the master document): answer
+            #conditional requests without reading the file or transcoding
+            quality = d.get("quality", audio.DEFAULT_QUALITY)
+            if "etag" in d:
+                etag, lastmodified = d["etag"], d.get("lastmodified")
+            elif "range" in d:
+                etag, lastmodified = conditional.file_validators(d["filename"], d["range"][0], d["range"][1],
+                                                                 quality, audio.PIPELINE_VERSION)
+            elif "audio" in d["mime"] and not d.get("normalized"):
+                etag, lastmodified = conditional.file_validators(d["filename"], quality, audio.PIPELINE_VERSION)
+            else:
+                etag, lastmodified = conditional.file_validators(d["filename"])
+            if conditional.is_fresh(conditional.from_env(env), etag, lastmodified):
+                if d.get("delete") == "Y": #not sent: remove now
+                    os.remove(d["filename"])
+                raise NotModifiedError(etag, lastmodified)
+            response_header = conditional.headers(etag, lastmodified)
 
-            LOG.info("{}".format(d))
             if "audio" in d["mime"]: # Send back audio
                 LOG.info(d["mime"])
-                error = ""
+                #Transcoded to a file: the pipeline slot is held while SoX
+                #runs, not while the client downloads
                 if "range" in d:
                     (start, end) = d['range']
-                    start = fix_oggsplt_time(start)
-                    end = fix_oggsplt_time(end)
-
-                    mp3splt = subprocess.Popen((MP3SPLT, d["filename"], start, end, "-d", "/tmp", "-o", os.path.basename(tmpout.name)), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    mp3splt_stdo, mp3splt_stde = mp3splt.communicate()
-                    LOG.info(mp3splt_stdo)
-                    error = "{}{}".format(error, mp3splt_stde)
-
-                    oggdec = subprocess.Popen((OGGDEC, "-o", tmpin.name, "{}.ogg".format(tmpout.name)), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    oggdec_stdo, oggdec_stde = oggdec.communicate()
-                    LOG.info(oggdec_stdo)
-                    error = "{}{}".format(error, oggdec_stde)
-                    
-                    sox = subprocess.Popen((SOX, "-t", "wav", tmpin.name, "-t", "wav", tmpout.name, "gain", "-n"), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    sox_stdo, sox_stde = sox.communicate()
-                    LOG.info(sox_stdo)
-                    error="{}{}".format(error, sox_stde)
-                   
-                    oggenc = subprocess.Popen((OGGENC, "-o", tmpin.name, tmpout.name), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    oggenc_stdo, oggenc_stde = oggenc.communicate()
-                    LOG.info(oggenc_stdo)
-                    error = "{}{}".format(error, oggenc_stde)
-
-                    with open(tmpin.name, "rb") as f:
-                        data = f.read()
-                    os.remove("{}.ogg".format(tmpout.name))
-                else:
-                    oggdec = subprocess.Popen((OGGDEC, "-o", tmpin.name, d["filename"]), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    oggdec_stdo, oggdec_stde = oggdec.communicate()
-                    LOG.info(oggdec_stdo)
-                    error = "{}{}".format(error, oggdec_stde)
-
-                    sox = subprocess.Popen((SOX, "-t", "wav", tmpin.name, "-t", "wav", tmpout.name, "gain", "-n"), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    sox_stdo, sox_stde = sox.communicate()
-                    LOG.info(sox_stdo)
-                    error="{}{}".format(error, sox_stde)
-
-                    oggenc = subprocess.Popen((OGGENC, "-o", tmpin.name, tmpout.name), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    oggenc_stdo, oggenc_stde = oggenc.communicate()
-                    LOG.info(oggenc_stdo)
-                    error = "{}{}".format(error, oggenc_stde)
-
-                    with open(tmpin.name, "rb") as f:
-                        data = f.read()
-
-                os.remove(tmpin.name)
-                os.remove(tmpout.name)
-                LOG.info(error)
-                LOG.info(len(data))
-                if error.lower().find('error:') != -1:
-                    LOG.error(error)
-                    raise RuntimeError("Cannot supply task's audio data!")
-    
+                    #Opened by the cache: may be evicted by another worker
+                    #once it has been looked up
+                    fh = AUDIOCACHE.open(d["filename"], start, end,
+                                         lambda outfile: audio.transcode(d["filename"], outfile, d["range"], quality),
+                                         quality)
+                elif d.get("normalized"): # Normalised at upload
+                    filename = d["filename"]
+                else: # Uploaded before renditions were created
+                    fh = AUDIOCACHE.open(d["filename"], None, None,
+                                         lambda outfile: audio.transcode(d["filename"], outfile, quality=quality),
+                                         quality)
+
             else: # Send back MS-WORD document
-                with open(d['filename'], 'rb') as infh:
-                    data = infh.read()
-                if d["delete"] == "Y":
-                    os.remove(d["filename"])
-                response_header = [("Content-Disposition", 'attachment; filename="{}"'.format(d["savename"]))]
+                filename = d["filename"]
+                delete = d.get("delete") == "Y"
+                response_header.append(("Content-Disposition", 'attachment; filename="{}"'.format(d["savename"])))
 
-            response_header.extend([('Content-Type', str(d["mime"])), ('Content-Length', str(len(data)))])
-            start_response('200 OK', response_header + ALLOW)
-            return [data]
+            #File is removed (if `delete`) once the server closes the response
+            if fh is not None: #already open
+                response = ResponseFile(fh.name, fh=fh)
+            else:
+                response = ResponseFile(filename, delete)
+            LOG.info(response.size)
+            status = '200 OK'
+            if "audio" in d["mime"]:
+                response_header.append(("Accept-Ranges", "bytes"))
+                if "HTTP_RANGE" in env:
+                    try:
+                        byterange = parse_range(env["HTTP_RANGE"], response.size)
+                    except ValueError as e:
+                        LOG.info("Range not satisfiable: {} ({})".format(env["HTTP_RANGE"], e))
+                        response.close()
+                        start_response('416 Requested Range Not Satisfiable',
+                                       [("Content-Range", "bytes */{}".format(response.size)), ("Content-Length", "0")] + ALLOW)
+                        return []
+                    if byterange is not None:
+                        response.set_range(*byterange)
+                        response_header.append(("Content-Range", "bytes {}-{}/{}".format(byterange[0], byterange[1], response.size)))
+                        status = '206 Partial Content'
+            response_header.extend([('Content-Type', str(d["mime"])), ('Content-Length', str(response.length))])
+            start_response(status, response_header + ALLOW)
+            return file_response(env, response)
 
         elif env['REQUEST_METHOD'] == 'POST':
             d = router.post(env)
-            response, response_header = build_json_response(d)
+            response, response_header = json_response(env, d)
             start_response('200 OK', response_header + ALLOW)
             return [response]
 
         elif env['REQUEST_METHOD'] == 'PUT':
             d = router.put(env)
-            response, response_header = build_json_response(d)
+            response, response_header = json_response(env, d)
             start_response('200 OK', response_header + ALLOW)
             return [response]
 
         elif env['REQUEST_METHOD'] == 'OPTIONS':
             response_header = [("Access-Control-Allow-Origin", "*"), ("Access-Control-Allow-Methods", "POST, PUT, GET, OPTIONS"), 
-            ("Access-Control-Allow-Headers", "Content-Type") ,("Access-Control-Max-Age", "86400")]
+            ("Access-Control-Allow-Headers", "Content-Type, Range, If-None-Match, If-Modified-Since") ,("Access-Control-Max-Age", "86400")]
             start_response('200 OK', response_header)
             return []
 
         else:
             raise MethodNotAllowedError("Supported methods are: GET, POST or PUT")
 
+    except NotModifiedError as e:
+        start_response("304 Not Modified", conditional.headers(e.etag, e.lastmodified) + [h for h in ALLOW if h[0] != "Content-Type"])
+        return []
     except BadRequestError as e:
         response, response_header = build_json_response(e)
         start_response("400 Bad Request", response_header)
@@ -226,6 +466,12 @@ def application(env, start_response):
         response, response_header = build_json_response(e)
         start_response("501 Not Implemented", response_header)
         return [response]
+    except ServiceUnavailableError as e:
+        response, response_header = build_json_response(e)
+        if e.retryafter is not None:
+            response_header.append(("Retry-After", str(e.retryafter)))
+        start_response("503 Service Unavailable", response_header)
+        return [response]
     except Exception as e:
         LOG.error("{}".format(e))
         response, response_header = build_json_response(e)